@@ -1,10 +1,47 @@
+import io
 import os
+import json
 import shutil
 import sys
+import threading
+import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from create_files import create_dockerfile, create_main_py, create_apify_json, create_input_schema, create_readme, \
-    update_reqs
+    update_reqs, get_reqs, write_reqs, get_project_name, create_apify_platform_py, create_incremental_py, \
+    get_incremental_settings, merge_settings, create_feed_export_py, get_feed_export_settings, FEED_EXPORT_FORMATS, \
+    create_adaptive_concurrency_py, get_adaptive_concurrency_settings, check_runtime_reqs, RUNTIMES, \
+    create_proxy_sessions_py, get_proxy_sessions_settings
+from scanner import iter_spider_files, scan_spider_files
+from load_test import load_test
+
+ARTIFACT_WORKERS = 8
+
+
+class ThreadOutput:
+    """
+    Stream which replaces sys.stdout while files of spider copies are generated in a thread pool. Output of a thread
+    which called capture() is collected, so output of concurrent spiders does not interleave. Other output goes through
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+
+    def release(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def write(self, text):
+        return (getattr(self.local, 'buffer', None) or self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
 
 
 def parse_input():
@@ -18,11 +55,59 @@ def parse_input():
                         type=str, dest='input_folder', const='.', nargs='?')
     parser.add_argument("-r", "--update-reqs", help="Creates or updates 'requirements.txt'. Default value is '.'",
                         type=str, dest='reqs_folder', const='.', nargs='?')
+    parser.add_argument("--incremental", help="Skips or conditionally requests items seen in the previous runs and "
+                                              "emits only new or changed items. Default value is 'conditional'",
+                        type=str, dest='incremental', const='conditional', nargs='?', choices=['conditional', 'skip'])
+    parser.add_argument("--feed-export", help="Exports items to compressed chunks in the default key-value store. "
+                                              "Default value is 'jsonl.gz'",
+                        type=str, dest='feed_export', const='jsonl.gz', nargs='?', choices=FEED_EXPORT_FORMATS)
+    parser.add_argument("--no-dataset", help="Items are not pushed to the default dataset. Use with '--feed-export'",
+                        dest='push_to_dataset', action='store_false')
+    parser.add_argument("--adaptive-concurrency", help="Tunes concurrency of each domain by latency, error rate and "
+                                                       "rate limit responses instead of AutoThrottle",
+                        dest='adaptive_concurrency', action='store_true')
+    parser.add_argument("--proxy-sessions", help="Sets proxy of requests from a pool of sticky sessions scored by "
+                                                 "latency and bans. Proxy is configured in the actor input",
+                        dest='proxy_sessions', action='store_true')
+    parser.add_argument("--runtime", help="Interpreter the actor is built for. Requirements are checked for C "
+                                          "extensions which do not fit PyPy. Default value is 'cpython'",
+                        type=str, dest='runtime', default='cpython', choices=RUNTIMES)
+    parser.add_argument("--load-test", help="Runs migrated actors locally against a mock website and a stand-in of "
+                                            "Apify API and reports their performance",
+                        type=str, dest='load_test_folders', nargs='+')
+    parser.add_argument("--pages", help="Number of pages of the mock website. Default value is 1000",
+                        type=int, dest='pages', default=1000)
+    parser.add_argument("--latency", help="Mean latency of the mock website in seconds. Default value is 0.05",
+                        type=float, dest='latency', default=0.05)
+    parser.add_argument("--error-rate", help="Ratio of 500 and 503 responses of the mock website. Default value is 0",
+                        type=float, dest='error_rate', default=0.0)
+    parser.add_argument("--settings", help="JSON of scrapy settings of a load test variant. Can be used repeatedly",
+                        type=json.loads, dest='settings_variants', action='append')
+    parser.add_argument("--input", help="JSON of the actor input used in a load test",
+                        type=json.loads, dest='actor_input')
+    parser.add_argument("--python", help="Interpreter which runs actors in a load test, e.g. 'pypy3'. Can be used "
+                                         "repeatedly to compare interpreters. Default value is the current interpreter",
+                        type=str, dest='interpreters', action='append')
+    parser.add_argument("--mock-proxy", help="Requests of a load test go through a stand-in of Apify Proxy. Value is "
+                                             "the ratio of banned or slow exits. Default value is 0.2",
+                        type=float, dest='proxy_bad_exits', const=0.2, nargs='?')
     args = parser.parse_args()
 
+    if args.load_test_folders:
+        load_test(args.load_test_folders, pages=args.pages, latency=args.latency, error_rate=args.error_rate,
+                  settings_variants=args.settings_variants, actor_input=args.actor_input,
+                  interpreters=args.interpreters, proxy_bad_exits=args.proxy_bad_exits)
+        return
+
+    if not args.push_to_dataset and not args.feed_export:
+        print("Option '--no-dataset' requires '--feed-export', otherwise items would not be saved.")
+        return
+
     if args.migrate_folder:
         # whole wrap
-        wrap_scrapy(args.migrate_folder)
+        wrap_scrapy(args.migrate_folder, incremental=args.incremental, feed_export=args.feed_export,
+                    push_to_dataset=args.push_to_dataset, adaptive_concurrency=args.adaptive_concurrency,
+                    runtime=args.runtime, proxy_sessions=args.proxy_sessions)
     else:
         # updates
         if args.input_folder:
@@ -31,54 +116,227 @@ def parse_input():
             update_reqs(args.reqs_folder)
 
 
-def wrap_scrapy(dst: str):
+def wrap_scrapy(dst: str, incremental=None, feed_export=None, push_to_dataset=True, adaptive_concurrency=False,
+                runtime='cpython', proxy_sessions=False):
     """
     Wrap scrapy project with files to be executable on Apify platform
     :param dst: directory which will be wrap with files
+    :param incremental: mode of incremental crawling ('conditional' or 'skip'), None to disable it
+    :param feed_export: format of chunks exported to the key-value store, None to disable it
+    :param push_to_dataset: if False, items are not pushed to the default dataset
+    :param adaptive_concurrency: if True, concurrency of each domain is tuned by AIMD controller
+    :param runtime: interpreter the actor is built for, one of RUNTIMES
+    :param proxy_sessions: if True, proxy of requests is set from a pool of sticky sessions
     """
+    extensions = {'incremental': incremental, 'feed_export': feed_export,
+                  'adaptive_concurrency': adaptive_concurrency, 'proxy_sessions': proxy_sessions}
+
+    # directory with several scrapy projects, e.g. a monorepo
+    if not os.path.exists(os.path.join(dst, 'scrapy.cfg')):
+        return wrap_scrapy_projects(dst, extensions, push_to_dataset, runtime)
+
+    if not confirm_overwrite(dst):
+        return False
+
+    return wrap_project(dst, get_spider_classes_in_files(iter_spider_files(dst)), extensions, push_to_dataset, runtime)
 
-    files_in_dir = os.listdir(dst)
-    files = ['requirements.txt', 'main.py', 'Dockerfile', 'apify.json', 'INPUT_SCHEMA.json']
 
-    # check if in scrapy root folder
-    if 'scrapy.cfg' not in files_in_dir:
+def wrap_scrapy_projects(dst, extensions, push_to_dataset=True, runtime='cpython'):
+    """
+    Wraps every scrapy project in a directory tree. The tree is walked once to find the projects, then only spider
+    modules of each project are scanned
+    :param dst: directory with scrapy projects
+    :param extensions: dictionary of keyword arguments of create_extensions
+    :param push_to_dataset: if False, items are not pushed to the default dataset
+    :param runtime: interpreter the actors are built for, one of RUNTIMES
+    :return: boolean of successfulness of all projects
+    """
+    files_of_projects = {}
+    for project_dir, path in scan_spider_files(dst):
+        files_of_projects.setdefault(project_dir, []).append(path)
+
+    if not files_of_projects:
         print('Select root directory with "scrapy.cfg" file.')
         return False
 
+    success = True
+    for project_dir in sorted(files_of_projects):
+        print('Migrating scrapy project', project_dir)
+        spiders = get_spider_classes_in_files(files_of_projects[project_dir])
+        success = confirm_overwrite(project_dir) \
+            and wrap_project(project_dir, spiders, extensions, push_to_dataset, runtime) and success
+    return success
+
+
+def confirm_overwrite(dst):
+    """
+    Asks the user to confirm overwriting of migration files which already exist in the project
+    :param dst: directory of scrapy project
+    :return: boolean, True if files can be created
+    """
+    files_in_dir = os.listdir(dst)
+    files = ['requirements.txt', 'main.py', 'apify_platform.py', 'Dockerfile', 'apify.json', 'INPUT_SCHEMA.json']
+
     # check if files that will be created exist
     for file in files:
         if file in files_in_dir:
-            print("If these files exists, they will be overwritten: 'requirements.txt', 'main.py', 'Dockerfile', "
-                  "'apify.json', 'INPUT_SCHEMA.json'. Do you wish to continue? [Y/N]")
+            print("If these files exists, they will be overwritten: 'requirements.txt', 'main.py', "
+                  "'apify_platform.py', 'Dockerfile', 'apify.json', 'INPUT_SCHEMA.json'. "
+                  "Do you wish to continue? [Y/N]")
             answer = sys.stdin.readline().strip()[0]
-            if not (answer == 'y' or answer == 'Y'):
-                return False
-            else:
-                break
+            return answer == 'y' or answer == 'Y'
+    return True
 
-    spider_dir = get_spiders_folder(dst)
 
+def wrap_project(dst, spiders, extensions, push_to_dataset=True, runtime='cpython'):
+    """
+    Creates migration files of one scrapy project, spiders of the project get their own copies of it
+    :param dst: directory with "scrapy.cfg" file
+    :param spiders: array of tuples of (spider_name, spider_file)
+    :param extensions: dictionary of keyword arguments of create_extensions
+    :param push_to_dataset: if False, items are not pushed to the default dataset
+    :param runtime: interpreter the actors are built for, one of RUNTIMES
+    :return: boolean of successfulness
+    """
     # could not find spider class
-    if not spider_dir:
+    if not spiders:
+        print('Could not find any spider class in', dst)
         return False
 
-    spiders = get_spider_classes(spider_dir)
-
     # found one spider class
     if len(spiders) == 1:
-        return create_or_update_input(dst, spiders[0]) and create_dockerfile(dst) \
-            and create_apify_json(dst) and create_main_py(dst, spiders[0][0], spiders[0][1]) \
-            and update_reqs(dst) and create_readme(dst, spiders[0][0])
+        proxy_sessions = extensions['proxy_sessions']
+        settings = create_extensions(dst, **extensions)
+        if not (settings is not None and create_or_update_input(dst, spiders[0], proxy_sessions)
+                and create_apify_json(dst)
+                and create_main_py(dst, spiders[0][0], spiders[0][1], settings, push_to_dataset, proxy_sessions)
+                and create_apify_platform_py(dst)):
+            return False
+
+        # Dockerfile depends on the requirements, which can make the actor fall back to CPython
+        reqs, runtime = check_runtime_reqs(get_reqs(dst), runtime)
+        return write_reqs(dst, reqs) and create_dockerfile(dst, runtime) and create_readme(dst, spiders[0][0])
 
     # found multiple spider classes
-    spider_names = [spider[0] for spider in spiders]
     copy_files(dst, spiders)
+    return create_spider_copies(dst, spiders, extensions, push_to_dataset, runtime)
+
 
+def create_spider_copies(dst, spiders, extensions, push_to_dataset=True, runtime='cpython'):
+    """
+    Creates migration files in the copy of the project of each spider. Facts shared by the copies (project name and
+    requirements) are resolved once and files of the copies are generated concurrently
+    :param dst: directory with copies of the project created by copy_files
+    :param spiders: array of tuples of (spider_name, spider_file)
+    :param extensions: dictionary of keyword arguments of create_extensions
+    :param push_to_dataset: if False, items are not pushed to the default dataset
+    :param runtime: interpreter the actors are built for, one of RUNTIMES
+    :return: boolean of successfulness
+    """
+    start = time.perf_counter()
+    project_name = get_project_name(dst)
+
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=ARTIFACT_WORKERS) as pool:
+            futures = [pool.submit(create_spider_files, dst, spider, project_name, extensions, push_to_dataset,
+                                   output) for spider in spiders]
+            results = [future.result() for future in futures]
+    finally:
+        sys.stdout = output.stream
+    files_duration = time.perf_counter() - start
+
+    # output of each spider is printed at once, in the order of spiders
+    for spider, result in zip(spiders, results):
+        for line in result[2].splitlines():
+            print(f'[{spider[0]}] {line}')
+
+    # copies differ only in the spider module. The project root contains every spider module and the first copy
+    # contains every generated file, so one pipreqs run over them covers all copies
+    reqs_start = time.perf_counter()
+    reqs, runtime = check_runtime_reqs(get_reqs(dst, ignore_dirs=[spider[0] for spider in spiders[1:]]), runtime)
+    # Dockerfile depends on the requirements, which can make the actors fall back to CPython
+    created = True
     for spider in spiders:
-        dst_of_spider = os.path.join(dst, spider[0])
-        create_or_update_input(dst_of_spider, spider) and create_dockerfile(dst_of_spider) \
-        and create_apify_json(dst_of_spider) and create_main_py(dst_of_spider, spider[0], spider[1]) \
-        and update_reqs(dst_of_spider) and create_readme(dst_of_spider, spider[0])
+        created = write_reqs(os.path.join(dst, spider[0]), reqs) \
+            and create_dockerfile(os.path.join(dst, spider[0]), runtime) and created
+    reqs_duration = time.perf_counter() - reqs_start
+
+    # pipreqs runs once and is not parallel, so it is reported apart from files of the copies
+    work_duration = sum(result[1] for result in results)
+    print(f'Created files of {len(spiders)} spiders in {files_duration:.2f}s '
+          f'({work_duration:.2f}s of work, speedup {work_duration / files_duration:.1f}x)')
+    print(f'Resolved requirements of all spiders in {reqs_duration:.2f}s')
+
+    return all(result[0] for result in results) and created
+
+
+def create_spider_files(dst, spider, project_name, extensions, push_to_dataset=True, output=None):
+    """
+    Creates migration files except requirements.txt and Dockerfile in the copy of the project of one spider
+    :param dst: directory with copies of the project
+    :param spider: tuple of (spider_name, spider_file)
+    :param project_name: name of the scrapy project
+    :param extensions: dictionary of keyword arguments of create_extensions
+    :param push_to_dataset: if False, items are not pushed to the default dataset
+    :param output: ThreadOutput which collects printed messages, None to print them directly
+    :return: tuple of (boolean of successfulness, duration in seconds, collected output)
+    """
+    start = time.perf_counter()
+    if output is not None:
+        output.capture()
+    dst_of_spider = os.path.join(dst, spider[0])
+    # spider module in the copy, so main.py does not point outside of the copy
+    spider_in_copy = (spider[0], os.path.join(dst_of_spider, os.path.relpath(spider[1], dst)))
+
+    try:
+        settings = create_extensions(dst_of_spider, **extensions)
+        success = settings is not None \
+            and create_or_update_input(dst_of_spider, spider_in_copy, extensions['proxy_sessions']) \
+            and create_apify_json(dst_of_spider, project_name) \
+            and create_main_py(dst_of_spider, spider_in_copy[0], spider_in_copy[1], settings, push_to_dataset,
+                               extensions['proxy_sessions']) \
+            and create_apify_platform_py(dst_of_spider) and create_readme(dst_of_spider, spider[0])
+    finally:
+        messages = output.release() if output is not None else ''
+
+    return bool(success), time.perf_counter() - start, messages
+
+
+def create_extensions(dst, incremental=None, feed_export=None, adaptive_concurrency=False, proxy_sessions=False):
+    """
+    Creates files of optional features and collects scrapy settings which enable them in main.py
+    :param dst: directory in which files are created
+    :param incremental: mode of incremental crawling ('conditional' or 'skip'), None to disable it
+    :param feed_export: format of chunks exported to the key-value store, None to disable it
+    :param adaptive_concurrency: if True, concurrency of each domain is tuned by AIMD controller
+    :param proxy_sessions: if True, proxy of requests is set from a pool of sticky sessions
+    :return: dictionary of scrapy settings or None if some file could not be created
+    """
+    settings = {}
+
+    if incremental:
+        if not create_incremental_py(dst):
+            return None
+        merge_settings(settings, get_incremental_settings(incremental))
+
+    if feed_export:
+        if not create_feed_export_py(dst, feed_export):
+            return None
+        merge_settings(settings, get_feed_export_settings(feed_export))
+
+    if adaptive_concurrency:
+        if not create_adaptive_concurrency_py(dst):
+            return None
+        merge_settings(settings, get_adaptive_concurrency_settings())
+
+    if proxy_sessions:
+        if not create_proxy_sessions_py(dst):
+            return None
+        merge_settings(settings, get_proxy_sessions_settings())
+
+    return settings
 
 
 def copy_files(dst, spiders):
@@ -104,10 +362,10 @@ def copy_files(dst, spiders):
 
     for i in range(1, len(spider_names)):
         shutil.copytree(first_copy_name, os.path.join(dst, spider_names[i]), ignore=shutil.ignore_patterns('.git*'))
-        shutil.copy(spiders[i][1], get_spiders_folder(os.path.join(dst, spider_names[i])))
+        shutil.copy(spiders[i][1], os.path.join(dst, spider_names[i], os.path.relpath(spiders[i][1], dst)))
 
-    # add script file to the first copy
-    shutil.copy(spiders[0][1], get_spiders_folder(first_copy_name))
+    # add script file to the first copy, spider modules can be in nested packages so the relative path is kept
+    shutil.copy(spiders[0][1], os.path.join(first_copy_name, os.path.relpath(spiders[0][1], dst)))
 
 
 def get_scrapy_list(dst):
@@ -143,28 +401,31 @@ def is_name_unique(client, name):
     return not (name in names)
 
 
-def create_or_update_input(dst, spider_tuple=None):
+def create_or_update_input(dst, spider_tuple=None, proxy_sessions=False):
     """
     Creates or updates INPUT_SCHEMA.json of a project. Tries to find a spider class if spider_tuple is not provided
     :param dst: destination of scrapy project
     :param spider_tuple: tuple of (spider_name, spider_destination)
+    :param proxy_sessions: if True, inputs of the proxy session middleware are added
     :return: boolean of successfulness
     """
 
     if spider_tuple is None:
-        spider_tuple = get_spider_classes(spiders_dir)
+        spiders = get_spider_classes_in_files(iter_spider_files(dst))
 
         if len(spiders) == 0:
-            print('No spiders found in "spiders" subdirectory.')
+            print('No spiders found in spider modules.')
             return None
 
         if len(spiders) > 1:
             print('Multiple spiders in one directory found. This method requires only one.')
             return None
 
+        spider_tuple = spiders[0]
+
     inputs = get_inputs(spider_tuple[1])
 
-    return create_input_schema(os.path.join(dst), spider_tuple[0], inputs)
+    return create_input_schema(os.path.join(dst), spider_tuple[0], inputs, proxy_sessions)
 
 
 def update_input(dst, spider):
@@ -172,42 +433,25 @@ def update_input(dst, spider):
     create_input_schema(dst, spider, inputs)
 
 
-def get_spiders_folder(dst):
-    """
-    Finds spiders folder in scrapy root directory
-    :param dst:  scrapy root directory
-    :return:  returns path to spiders folder or None
-    """
-    spiders_dir = None
-    for directory in os.listdir(dst):
-        if os.path.isdir(os.path.join(dst, directory, 'spiders')):
-            spiders_dir = os.path.join(dst, directory, 'spiders')
-            break
-
-    if spiders_dir is None:
-        print('Could not find any spider folder in', dst)
-
-    return spiders_dir
-
-
-def get_spider_classes(spiders_dir):
+def get_spider_classes_in_files(files):
     """
-    Find classes with scrapy.Spider argument in spiders directory
-    :param spiders_dir: spiders directory
+    Find classes with scrapy.Spider argument in files
+    :param files: iterable of paths to python files, can be a lazy generator
     :return: array of tuples of (name, path) of spider classes
     """
     spiders = []
 
-    for file in os.listdir(spiders_dir):
-        if file.endswith(".py"):
-            file_to_read = open(os.path.join(spiders_dir, file), 'r')
-            for line in file_to_read.readlines():
+    for path in files:
+        with open(path, 'r') as file_to_read:
+            for line in file_to_read:
                 stripped = line.strip()
                 if stripped.startswith('class') and stripped.endswith('(scrapy.Spider):'):
                     class_name = stripped.split(' ')[1].split('(')[0]
-                    spiders.append((class_name, os.path.join(spiders_dir, file)))
+                    spiders.append((class_name, path))
                     break  # TODO: is break OK? I think its better than rewriting it with while loop
 
+    # files are streamed by parallel threads, keep the result deterministic
+    spiders.sort(key=lambda spider: spider[1])
     return spiders
 
 
@@ -1,11 +1,33 @@
 import os
 import re
 import subprocess
+from pprint import pformat
 
 
 ##########################################
 # requirements.txt
 ##########################################
+# interpreters the actor can be built for
+RUNTIMES = ['cpython', 'pypy']
+
+# C extensions which do not fit PyPy, tuple of (action, replacement, reason)
+# replace - requirement is swapped for a drop-in replacement
+# warn - package works through cpyext emulation layer, but it is slower than on CPython
+# fallback - package cannot be installed or run on PyPy, the actor is built for CPython
+PYPY_INCOMPATIBLE_REQS = {
+    'brotli': ('replace', 'brotlicffi~=1.1', 'scrapy decompresses br responses with the CFFI binding as well'),
+    'lxml': ('warn', None, 'parsing runs through cpyext, selector heavy callbacks can gain less from the JIT'),
+    'numpy': ('warn', None, 'it runs through cpyext and its calls are slower than on CPython'),
+    'pandas': ('warn', None, 'it runs through cpyext and its calls are slower than on CPython'),
+    'pyarrow': ('fallback', None, 'no PyPy builds, required by parquet feed export'),
+    'orjson': ('fallback', None, 'PyPy is not supported'),
+    'numba': ('fallback', None, 'PyPy is not supported'),
+    'psycopg2': ('fallback', None, 'use psycopg2cffi on PyPy'),
+    'psycopg2-binary': ('fallback', None, 'use psycopg2cffi on PyPy'),
+    'mysqlclient': ('fallback', None, 'use PyMySQL on PyPy'),
+}
+
+
 def update_reqs(dst):
     """
     Creates or updates requirements.txt of a project. Runs pipreqs. If requirements exists, appends with pipreqs result
@@ -18,49 +40,113 @@ def update_reqs(dst):
         print('Select root directory with "scrapy.cfg" file.')
         return False
 
+    # requirements of an actor built for PyPy are checked the same way as in the migration
+    dockerfile_runtime = get_dockerfile_runtime(dst)
+    reqs, runtime = check_runtime_reqs(get_reqs(dst), dockerfile_runtime)
+    if not write_reqs(dst, reqs):
+        return False
+    if runtime != dockerfile_runtime:
+        return create_dockerfile(dst, runtime)
+    return True
+
+
+def get_reqs(dst, ignore_dirs=None):
+    """
+    Runs pipreqs in a directory and merges the result with requirements.txt of the directory, if it exists
+    :param dst: destination of scrapy project
+    :param ignore_dirs: names of directories which are not scanned by pipreqs
+    :return: array of lines of requirements
+    """
     import pipreqs
     reqs_file = os.path.join(dst, 'requirements.txt')
 
-    # check if requirements.txt exists
-    if not os.path.exists(os.path.join(dst, 'requirements.txt')):
-
-        # compat mode for ~= requirements, supress output
-        subprocess.run(["pipreqs", dst, "--mode", "compat"], stderr=subprocess.DEVNULL)
-        with open(reqs_file, 'r') as reqs:
-            unsafe_split_lines = [re.split('[~=<]=', x) for x in reqs.read().splitlines(keepends=False)]
-            lines = remove_invalid_reqs(unsafe_split_lines)
-        with open(reqs_file, 'w') as reqs:
-            reqs.writelines([x[0] + '~=' + x[1] + '\n' for x in lines])
-        print('Created requirements.txt')
-        return True
-
-    # create tmp file to save user requirements and call pipreqs
+    # pipreqs result is saved to tmp file, so user requirements are kept
     reqs_tmp = os.path.join(dst, '.tmp_reqs.tmp_apify')
 
     if os.path.exists(reqs_tmp):
         # if tmp file exists, removes it. It should be created only in runs before and shouldn't be user's file.
         os.remove(reqs_tmp)
 
-    os.rename(reqs_file, reqs_tmp)
-    subprocess.run(["pipreqs", dst, "--mode", "compat"], stderr=subprocess.DEVNULL)
+    # compat mode for ~= requirements, supress output
+    command = ["pipreqs", dst, "--mode", "compat", "--savepath", reqs_tmp]
+    if ignore_dirs:
+        command.extend(["--ignore", ",".join(ignore_dirs)])
+    subprocess.run(command, stderr=subprocess.DEVNULL)
+
+    with open(reqs_tmp, 'r') as tmp:
+        reqs_lines = tmp.read().splitlines(keepends=False)
+    os.remove(reqs_tmp)
+
+    # check if requirements.txt exists
+    if not os.path.exists(reqs_file):
+        unsafe_split_lines = [re.split('[~=<]=', x) for x in reqs_lines]
+        return [x[0] + '~=' + x[1] for x in remove_invalid_reqs(unsafe_split_lines)]
 
     # check for duplicates
     with open(reqs_file, 'r') as reqs:
-        reqs_lines = reqs.read().splitlines(keepends=False)
-    with open(reqs_tmp, 'r') as tmp:
-        tmp_lines = tmp.read().splitlines(keepends=False)
+        user_lines = reqs.read().splitlines(keepends=False)
+
+    return concat_dedup_reqs(reqs_lines, user_lines)
 
-    complete_reqs = concat_dedup_reqs(reqs_lines, tmp_lines)
 
-    with open(reqs_file, 'w') as reqs:
-        for req in complete_reqs:
+def write_reqs(dst, lines):
+    """
+    Writes requirements.txt of a project
+    :param dst: destination of scrapy project
+    :param lines: array of lines of requirements
+    :return: boolean of successfulness
+    """
+    with open(os.path.join(dst, 'requirements.txt'), 'w') as reqs:
+        for req in lines:
             reqs.write(req + '\n')
 
-    os.remove(reqs_tmp)
     print('Created requirements.txt')
     return True
 
 
+def check_runtime_reqs(lines, runtime):
+    """
+    Checks requirements against known C extension incompatibilities of the runtime. Packages with a drop-in replacement
+    are replaced, packages which are slower on the runtime are reported and packages which cannot be installed or run
+    on the runtime make the actor fall back to CPython
+    :param lines: array of lines of requirements
+    :param runtime: one of RUNTIMES
+    :return: tuple of (array of lines of requirements, runtime of the actor)
+    """
+    if runtime != 'pypy':
+        return lines, runtime
+
+    checked = []
+    blockers = []
+    names = set()
+
+    for line in lines:
+        name = re.split('[~=<>!]=?', line, maxsplit=1)[0].strip()
+        names.add(name.lower().replace('_', '-'))
+        action, replacement, reason = PYPY_INCOMPATIBLE_REQS.get(name.lower().replace('_', '-'), (None, None, None))
+
+        if action == 'replace':
+            print(f"PyPy: '{name}' is replaced by '{replacement}', {reason}.")
+            checked.append(replacement)
+            continue
+        if action == 'warn':
+            print(f"PyPy: '{name}' is kept, but {reason}.")
+        elif action == 'fallback':
+            blockers.append(f"'{name}' ({reason})")
+        checked.append(line)
+
+    if blockers:
+        print('PyPy: falling back to CPython, because of', ', '.join(blockers) + '.')
+        return lines, 'cpython'
+
+    # lxml is installed by scrapy, pipreqs lists only packages imported by the project
+    if 'lxml' not in names:
+        print(f"PyPy: 'lxml' is installed by scrapy, {PYPY_INCOMPATIBLE_REQS['lxml'][2]}.")
+
+    # requirements updated before already have the replacement
+    return list(dict.fromkeys(checked)), runtime
+
+
 def concat_dedup_reqs(reqs_lines, user_lines):
     """
     Check lines of requirements and concatenates them and removes duplicates. Users' versions will be preferred
@@ -134,19 +220,22 @@ def is_valid_version(v):
 ##########################################
 # main.py
 ##########################################
-def create_main_py(dst, module_name, path):
+def create_main_py(dst, module_name, path, settings=None, push_to_dataset=True, proxy_sessions=False):
     """
     Creates main.py file and fills it with content
     :param dst: directory in which file is created
     :param module_name: name of the module with spider class
     :param path: path to the script with module
+    :param settings: dictionary of scrapy settings added to the spider by the migrator
+    :param push_to_dataset: if False, items are not pushed to the default dataset (e.g. when only feeds are exported)
+    :param proxy_sessions: if True, proxy is set by the proxy session middleware instead of environment variables
     :return: boolean of successfulness
     """
     try:
         # get relative path of main.py
         rel_path = os.path.relpath(path, dst)
         main_py = open(os.path.join(dst, "main.py"), "w")
-        main_py.write(get_main_py_content(module_name, rel_path))
+        main_py.write(get_main_py_content(module_name, rel_path, settings, push_to_dataset, proxy_sessions))
         main_py.close()
         print('Created main.py')
     except FileExistsError:
@@ -155,7 +244,23 @@ def create_main_py(dst, module_name, path):
     return True
 
 
-def get_main_py_content(module_name, path):
+def merge_settings(settings, extra):
+    """
+    Merges scrapy settings of an optional feature into settings. Dictionary settings such as
+    DOWNLOADER_MIDDLEWARES or ITEM_PIPELINES are merged instead of overwritten
+    :param settings: dictionary of scrapy settings which is updated
+    :param extra: dictionary of scrapy settings to be added
+    :return: updated settings
+    """
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(settings.get(key), dict):
+            settings[key].update(value)
+        else:
+            settings[key] = value
+    return settings
+
+
+def get_main_py_content(module_name, path, settings=None, push_to_dataset=True, proxy_sessions=False):
     # override windows path style
     path = path.replace('\\', '/')
     path = path.replace('\\\\', '/')
@@ -163,15 +268,51 @@ def get_main_py_content(module_name, path):
     Returns content for main.py
     :param module_name: name of the module with spider class
     :param path: path to the script with the module
+    :param settings: dictionary of scrapy settings added to the spider by the migrator
+    :param push_to_dataset: if False, items are not pushed to the default dataset
+    :param proxy_sessions: if True, proxy is set by the proxy session middleware instead of environment variables
     :return: str of main.py content
     """
+    # only names used by the parts of main.py below are imported
+    platform_imports = ['get_platform_client', 'prefetch']
+    if not proxy_sessions:
+        platform_imports.append('get_proxy_url')
+    scrapy_imports = ''
+    if push_to_dataset:
+        platform_imports.append('DatasetPusher')
+        scrapy_imports = 'from scrapy import signals\n'
+
     return f"""import os
 import sys
+import json
 import importlib.util
 import importlib  
-from apify_scrapy_executor import SpiderExecutor
 
-from apify_client import ApifyClient
+from apify_platform import {', '.join(platform_imports)}
+
+# input, dataset and proxy password are fetched in background threads while scrapy and the spider are loaded
+platform_client = get_platform_client()
+prefetched = prefetch(platform_client)
+
+{scrapy_imports}from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+# settings added by the migrator, dictionaries are merged with the project and spider settings
+MIGRATOR_SETTINGS = {pformat(settings or {})}
+
+
+def add_custom_settings(spider_class, settings):
+    project_settings = get_project_settings()
+    custom_settings = dict(spider_class.custom_settings or {{}})
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            merged = project_settings.getdict(key)
+            merged.update(custom_settings.get(key) or {{}})
+            merged.update(value)
+            value = merged
+        custom_settings[key] = value
+    spider_class.custom_settings = custom_settings
+
 
 # loading spider module
 spec = importlib.util.spec_from_file_location('{module_name}', '{path}')
@@ -179,31 +320,1342 @@ module = importlib.util.module_from_spec(spec)
 sys.modules[module.__name__] = module
 spec.loader.exec_module(module)
 
+# installs the reactor
+process = CrawlerProcess(get_project_settings())
+
 # get input from Apify platform
-client = ApifyClient(os.environ['APIFY_TOKEN'], api_url=os.environ['APIFY_API_BASE_URL'])
-default_kv_store_client = client.key_value_store(os.environ['APIFY_DEFAULT_KEY_VALUE_STORE_ID'])
-actor_input = default_kv_store_client.get_record(os.environ['APIFY_INPUT_KEY'])['value']
+actor_input = prefetched['input'].result() or {{}}
+{get_main_py_proxy_content(proxy_sessions)}
 
-# run the spider
 # TODO: shouldn't have getattr
-spider_executor = SpiderExecutor(getattr(module, '{module_name}'))
-spider_executor.run(dataset_id=os.environ['APIFY_DEFAULT_DATASET_ID'], args_dict=actor_input)"""
+spider_class = getattr(module, '{module_name}')
+add_custom_settings(spider_class, MIGRATOR_SETTINGS)
+if os.environ.get('MIGRATOR_EXTRA_SETTINGS'):
+    # settings of a local run, e.g. by the load test of the migrator
+    add_custom_settings(spider_class, json.loads(os.environ['MIGRATOR_EXTRA_SETTINGS']))
+
+# run the spider, input is passed as spider arguments
+crawler = process.create_crawler(spider_class)
+{get_main_py_run_content(push_to_dataset)}
+process.crawl(crawler, **actor_input)
+process.start()
+{get_main_py_exit_content(push_to_dataset)}"""
+
+
+def get_main_py_proxy_content(proxy_sessions):
+    """
+    Returns the part of main.py which sets the proxy from the actor input
+    :param proxy_sessions: if True, proxy is set by the proxy session middleware
+    :return: str of the main.py part
+    """
+    if proxy_sessions:
+        return """# proxy of each request is set by the proxy session middleware. The configuration is not passed by
+# settings, because they are logged and proxy urls can contain passwords
+os.environ['PROXY_SESSIONS_CONFIGURATION'] = json.dumps(actor_input.pop('proxyConfiguration', None))
+for input_key, setting in [('proxySessionPoolSize', 'PROXY_SESSIONS_POOL_SIZE'),
+                           ('proxySessionMaxUsage', 'PROXY_SESSIONS_MAX_USAGE')]:
+    value = actor_input.pop(input_key, None)
+    if value is not None:
+        MIGRATOR_SETTINGS[setting] = value"""
+
+    return """proxy_url = get_proxy_url(actor_input.pop('proxyConfiguration', None), prefetched['proxy_password'])
+if proxy_url:
+    # picked up by scrapy HttpProxyMiddleware, platform calls do not use environment proxies
+    os.environ['http_proxy'] = os.environ['https_proxy'] = proxy_url"""
+
+
+def get_main_py_run_content(push_to_dataset):
+    """
+    Returns the part of main.py which connects the crawler to the default dataset
+    :param push_to_dataset: if True, items are pushed to the default dataset
+    :return: str of the main.py part
+    """
+    if push_to_dataset:
+        return """dataset_pusher = DatasetPusher(platform_client, prefetched['dataset'].result()['id'])
+crawler.signals.connect(dataset_pusher.item_scraped, signal=signals.item_scraped)
+crawler.signals.connect(dataset_pusher.spider_closed, signal=signals.spider_closed)"""
+
+    return """# items are only exported by feeds, the default dataset is not used"""
+
+
+def get_main_py_exit_content(push_to_dataset):
+    """
+    Returns the end of main.py which fails the run if scraped items were lost
+    :param push_to_dataset: if True, items are pushed to the default dataset
+    :return: str of the main.py part
+    """
+    if push_to_dataset:
+        return """if dataset_pusher.unpushed_count:
+    sys.exit(f'{dataset_pusher.unpushed_count} items were not pushed to the dataset')"""
+
+    return ''
+
+
+##########################################
+# apify_platform.py
+##########################################
+def create_apify_platform_py(dst):
+    """
+    Creates apify_platform.py file with the client used for every Apify platform call of the actor
+    :param dst: directory in which file is created
+    :return: boolean of successfulness
+    """
+    try:
+        apify_platform_py = open(os.path.join(dst, "apify_platform.py"), "w")
+        apify_platform_py.write(get_apify_platform_py_content())
+        apify_platform_py.close()
+        print('Created apify_platform.py')
+    except FileExistsError:
+        print("Tried to create file 'apify_platform.py', but file already exists.")
+        return False
+    return True
+
+
+def get_apify_platform_py_content():
+    """
+    Returns content for apify_platform.py
+    :return: str of apify_platform.py content
+    """
+    return '''import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from itemadapter import ItemAdapter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+_prefetched = {}
+
+
+def get_platform_client():
+    """
+    Returns client shared by every platform call of the actor, so connections are kept alive and reused
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_url = os.environ.get('APIFY_API_BASE_URL') or 'https://api.apify.com'
+            _client = PlatformClient(os.environ['APIFY_TOKEN'], api_url)
+        return _client
+
+
+def prefetch(client):
+    """
+    Starts fetching data needed before the crawl in background threads
+    :return: dictionary of futures of 'input', 'dataset' and 'proxy_password'
+    """
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='prefetch')
+    futures = {
+        'input': executor.submit(client.get_record, os.environ['APIFY_DEFAULT_KEY_VALUE_STORE_ID'],
+                                 os.environ.get('APIFY_INPUT_KEY', 'INPUT')),
+        'dataset': executor.submit(client.get_dataset, os.environ['APIFY_DEFAULT_DATASET_ID']),
+        'proxy_password': executor.submit(client.get_proxy_password),
+    }
+    executor.shutdown(wait=False)
+    with _client_lock:
+        _prefetched.update(futures)
+    return futures
+
+
+def get_proxy_password_future():
+    """
+    Returns future of the Apify Proxy password prefetched by main.py, so the reactor does not wait for the API. If it
+    was not prefetched, it is fetched in a background thread
+    """
+    client = get_platform_client()
+    with _client_lock:
+        if 'proxy_password' not in _prefetched:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+            _prefetched['proxy_password'] = executor.submit(client.get_proxy_password)
+            executor.shutdown(wait=False)
+        return _prefetched['proxy_password']
+
+
+def get_proxy_url(proxy_configuration, proxy_password, session_id=None, index=0):
+    """
+    Resolves proxy url from the proxyConfiguration input field
+    :param proxy_configuration: dictionary with useApifyProxy, apifyProxyGroups, apifyProxyCountry or proxyUrls
+    :param proxy_password: future of the Apify Proxy password
+    :param session_id: id of Apify Proxy session, requests of one session go through the same IP address
+    :param index: index of the url from proxyUrls
+    :return: str of proxy url or None
+    """
+    if not proxy_configuration:
+        return None
+
+    if proxy_configuration.get('proxyUrls'):
+        proxy_urls = proxy_configuration['proxyUrls']
+        return proxy_urls[index % len(proxy_urls)]
+
+    if not proxy_configuration.get('useApifyProxy'):
+        return None
+
+    username = []
+    if proxy_configuration.get('apifyProxyGroups'):
+        username.append('groups-' + '+'.join(proxy_configuration['apifyProxyGroups']))
+    if proxy_configuration.get('apifyProxyCountry'):
+        username.append('country-' + proxy_configuration['apifyProxyCountry'])
+    if session_id:
+        username.append('session-' + session_id)
+
+    hostname = os.environ.get('APIFY_PROXY_HOSTNAME', 'proxy.apify.com')
+    port = os.environ.get('APIFY_PROXY_PORT', '8000')
+    return f"http://{','.join(username) or 'auto'}:{proxy_password.result()}@{hostname}:{port}"
+
+
+class PlatformClient:
+    """
+    Client of Apify API with one pooled keep-alive session. Failed requests are retried with exponential backoff,
+    Retry-After header is respected
+    """
+
+    def __init__(self, token, api_url, pool_size=16, retries=8, backoff_factor=0.5, timeout=60):
+        self.api_url = api_url.rstrip('/') + '/v2'
+        self.timeout = timeout
+        self.session = requests.Session()
+        # proxy of the crawl is set by environment variables, platform calls go directly
+        self.session.trust_env = False
+        self.session.headers['Authorization'] = f'Bearer {token}'
+
+        # POST is not idempotent, a retried push of items could store them twice
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, self.api_url + path, **kwargs)
+
+    def get_record(self, store_id, key):
+        response = self.request('GET', f'/key-value-stores/{store_id}/records/{quote(key)}')
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        if 'application/json' in response.headers.get('Content-Type', ''):
+            return response.json()
+        return response.content
+
+    def set_record(self, store_id, key, value, content_type=None):
+        if content_type is None:
+            value = json.dumps(value, default=str).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        response = self.request('PUT', f'/key-value-stores/{store_id}/records/{quote(key)}', data=value,
+                                headers={'Content-Type': content_type})
+        response.raise_for_status()
+
+    def get_or_create_store(self, name):
+        response = self.request('POST', '/key-value-stores', params={'name': name})
+        response.raise_for_status()
+        return response.json()['data']['id']
+
+    def get_dataset(self, dataset_id):
+        response = self.request('GET', f'/datasets/{dataset_id}')
+        response.raise_for_status()
+        return response.json()['data']
+
+    def push_items(self, dataset_id, items):
+        response = self.request('POST', f'/datasets/{dataset_id}/items',
+                                data=json.dumps(items, default=str).encode('utf-8'),
+                                headers={'Content-Type': 'application/json; charset=utf-8'})
+        response.raise_for_status()
+
+    def get_proxy_password(self):
+        if os.environ.get('APIFY_PROXY_PASSWORD'):
+            return os.environ['APIFY_PROXY_PASSWORD']
+        response = self.request('GET', '/users/me')
+        if not response.ok:
+            return None
+        return response.json()['data'].get('proxy', {}).get('password')
+
+
+class DatasetPusher:
+    """
+    Pushes scraped items to a dataset in batches from a background thread, so the reactor is not blocked.
+    Batches which could not be pushed are kept and pushed again, items are not lost when the API is unavailable
+    """
+
+    def __init__(self, client, dataset_id, batch_size=100, max_delay=5, close_retries=5, backoff_factor=0.5):
+        self.client = client
+        self.dataset_id = dataset_id
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.close_retries = close_retries
+        self.backoff_factor = backoff_factor
+        self.items = []
+        # batches which were not pushed yet, only used by the worker thread
+        self.pending = []
+        self.last_flush = time.monotonic()
+        # one worker keeps the order of items
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dataset')
+
+    @property
+    def unpushed_count(self):
+        return sum(len(items) for items in self.pending)
+
+    def item_scraped(self, item, response, spider):
+        self.items.append(ItemAdapter(item).asdict())
+        if len(self.items) >= self.batch_size or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self.items:
+            items, self.items = self.items, []
+            self.executor.submit(self.push, items)
+        self.last_flush = time.monotonic()
+
+    def push(self, items=None):
+        """
+        Pushes batches which failed before and then the new batch, so the order of items is kept
+        :param items: list of new items
+        :return: True if all batches were pushed
+        """
+        if items:
+            self.pending.append(items)
+        while self.pending:
+            try:
+                self.client.push_items(self.dataset_id, self.pending[0])
+            except Exception as e:
+                logger.warning(f'Could not push {self.unpushed_count} items to dataset, they will be pushed again: {e}')
+                return False
+            self.pending.pop(0)
+        return True
+
+    def push_remaining(self):
+        for attempt in range(self.close_retries):
+            if self.push():
+                return
+            time.sleep(self.backoff_factor * 2 ** attempt)
+        logger.error(f'Could not push {self.unpushed_count} items to dataset')
+
+    def spider_closed(self, spider):
+        self.flush()
+        self.executor.submit(self.push_remaining)
+        self.executor.shutdown(wait=True)
+'''
+
+
+##########################################
+# apify_incremental.py
+##########################################
+def create_incremental_py(dst):
+    """
+    Creates apify_incremental.py file with middleware and pipeline for incremental crawling
+    :param dst: directory in which file is created
+    :return: boolean of successfulness
+    """
+    try:
+        incremental_py = open(os.path.join(dst, "apify_incremental.py"), "w")
+        incremental_py.write(get_incremental_py_content())
+        incremental_py.close()
+        print('Created apify_incremental.py')
+    except FileExistsError:
+        print("Tried to create file 'apify_incremental.py', but file already exists.")
+        return False
+    return True
+
+
+def get_incremental_settings(mode='conditional'):
+    """
+    Returns scrapy settings which enable incremental crawling in main.py
+    :param mode: 'conditional' sends conditional requests for known urls, 'skip' does not request them at all
+    :return: dictionary of scrapy settings
+    """
+    return {
+        'DOWNLOADER_MIDDLEWARES': {'apify_incremental.IncrementalDownloaderMiddleware': 950},
+        'ITEM_PIPELINES': {'apify_incremental.IncrementalPipeline': 999},
+        'INCREMENTAL_MODE': mode,
+        'INCREMENTAL_KEY_FIELD': 'url',
+        'INCREMENTAL_INDEX_KEY': 'INCREMENTAL_INDEX',
+        'INCREMENTAL_INDEX_SHARDS': 16,
+        'INCREMENTAL_PERSIST_INTERVAL': 60,
+        'INCREMENTAL_MAX_VALIDATORS': 10000,
+    }
+
+
+def get_incremental_py_content():
+    """
+    Returns content for apify_incremental.py
+    :return: str of apify_incremental.py content
+    """
+    return '''import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from apify_platform import get_platform_client
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import DropItem, IgnoreRequest
+from twisted.internet import reactor, task
+
+logger = logging.getLogger(__name__)
+
+
+def get_seen_index(crawler):
+    """
+    Returns index shared by the middleware and the pipeline of one crawler
+    """
+    index = getattr(crawler, 'seen_index', None)
+    if index is None:
+        index = SeenIndex(crawler)
+        crawler.seen_index = index
+    return index
+
+
+class SeenIndex:
+    """
+    Index of seen items persisted in a named key-value store, so it survives between runs.
+    Entries are stored as key -> {'hash', 'etag', 'last_modified', 'seen_at'}. The index is split to
+    INCREMENTAL_INDEX_SHARDS records, so it does not hit the size limit of a record, and changed shards are saved every
+    INCREMENTAL_PERSIST_INTERVAL seconds, so an aborted run keeps most of the index
+    """
+
+    def __init__(self, crawler):
+        self.settings = crawler.settings
+        self.stats = crawler.stats
+        self.index_key = self.settings.get('INCREMENTAL_INDEX_KEY')
+        self.shards = [{} for _ in range(max(1, self.settings.getint('INCREMENTAL_INDEX_SHARDS', 16)))]
+        self.dirty = set()
+        # validators of downloaded responses which are not yet paired with an item. The oldest are dropped first,
+        # so validators of listing pages, which never produce an item, do not accumulate
+        self.validators = OrderedDict()
+        self.max_validators = self.settings.getint('INCREMENTAL_MAX_VALIDATORS', 10000)
+        self.store_id = None
+        self.loop = None
+        # one worker keeps the order of uploads
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='incremental')
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def get_shard(self, key):
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % len(self.shards)
+
+    def get(self, key):
+        return self.shards[self.get_shard(key)].get(key)
+
+    def put(self, key, entry):
+        shard = self.get_shard(key)
+        self.shards[shard][key] = entry
+        self.dirty.add(shard)
+
+    def add_validators(self, url, etag, last_modified):
+        self.validators[url] = (etag, last_modified)
+        self.validators.move_to_end(url)
+        while len(self.validators) > self.max_validators:
+            self.validators.popitem(last=False)
+
+    def pop_validators(self, key):
+        return self.validators.pop(key, (None, None))
+
+    def spider_opened(self, spider):
+        client = get_platform_client()
+        store_name = self.settings.get('INCREMENTAL_STORE_NAME') or f'{spider.name}-incremental'
+        store_name = re.sub('[^a-z0-9-]+', '-', store_name.lower()).strip('-')
+        self.store_id = client.get_or_create_store(store_name)
+
+        manifest = client.get_record(self.store_id, self.index_key)
+        stored_shards = manifest.get('shards', 0) if isinstance(manifest, dict) else 0
+        for number in range(stored_shards):
+            record = client.get_record(self.store_id, self.get_shard_key(number))
+            if isinstance(record, dict):
+                for key, entry in record.items():
+                    self.shards[self.get_shard(key)][key] = entry
+        if stored_shards != len(self.shards):
+            # number of shards changed, entries moved between shards
+            self.dirty.update(range(len(self.shards)))
+        self.stats.set_value('incremental/index_size_start', len(self))
+
+        interval = self.settings.getfloat('INCREMENTAL_PERSIST_INTERVAL', 60)
+        if interval > 0:
+            self.loop = task.LoopingCall(self.persist)
+            self.loop.start(interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.store_id is None:
+            return
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.persist()
+        self.executor.shutdown(wait=True)
+        self.stats.set_value('incremental/index_size_end', len(self))
+
+    def get_shard_key(self, number):
+        return f'{self.index_key}-{number:03d}'
+
+    def persist(self):
+        """
+        Serializes changed shards in the reactor thread and uploads them in the background
+        """
+        if not self.dirty:
+            return
+        records = [(number, self.get_shard_key(number), json.dumps(self.shards[number]).encode('utf-8'))
+                   for number in sorted(self.dirty)]
+        # manifest is written after the shards, so it never lists a shard which was not saved
+        records.append((None, self.index_key, json.dumps({'shards': len(self.shards)}).encode('utf-8')))
+        self.dirty.clear()
+        self.executor.submit(self.upload, records)
+
+    def upload(self, records):
+        client = get_platform_client()
+        for number, key, body in records:
+            try:
+                client.set_record(self.store_id, key, body, 'application/json; charset=utf-8')
+            except Exception:
+                logger.exception(f'Could not save {key} of the incremental index')
+                if number is not None:
+                    # saved again by the next persist
+                    reactor.callFromThread(self.dirty.add, number)
+
+
+class IncrementalDownloaderMiddleware:
+    """
+    Skips or sends conditional requests for urls which produced an item in the previous runs.
+    Set request.meta['incremental_ignore'] to always download the request
+    """
+
+    def __init__(self, index, mode):
+        self.index = index
+        self.mode = mode
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_seen_index(crawler), crawler.settings.get('INCREMENTAL_MODE', 'conditional'))
+
+    def process_request(self, request, spider):
+        if request.meta.get('incremental_ignore'):
+            return None
+
+        entry = self.index.get(request.url)
+        if entry is None:
+            return None
+
+        if self.mode == 'skip':
+            self.index.stats.inc_value('incremental/skipped')
+            raise IgnoreRequest(f'Already seen: {request.url}')
+
+        if entry.get('etag'):
+            request.headers.setdefault('If-None-Match', entry['etag'])
+        if entry.get('last_modified'):
+            request.headers.setdefault('If-Modified-Since', entry['last_modified'])
+        return None
+
+    def process_response(self, request, response, spider):
+        entry = self.index.get(request.url) if response.status == 304 else None
+        if entry is not None:
+            self.index.stats.inc_value('incremental/not_modified')
+            self.index.put(request.url, dict(entry, seen_at=int(time.time())))
+            raise IgnoreRequest(f'Not modified: {request.url}')
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.index.add_validators(response.url, etag.decode('latin-1') if etag else None,
+                                      last_modified.decode('latin-1') if last_modified else None)
+        return response
+
+
+class IncrementalPipeline:
+    """
+    Drops items whose content did not change since the previous run and updates the index.
+    Items are identified by the INCREMENTAL_KEY_FIELD field, items without it are always emitted
+    """
+
+    def __init__(self, index, key_field):
+        self.index = index
+        self.key_field = key_field
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_seen_index(crawler), crawler.settings.get('INCREMENTAL_KEY_FIELD', 'url'))
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        key = adapter.get(self.key_field)
+        if not key:
+            return item
+
+        key = str(key)
+        content = json.dumps(adapter.asdict(), sort_keys=True, default=str)
+        content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        etag, last_modified = self.index.pop_validators(key)
+
+        previous = self.index.get(key)
+        self.index.put(key, {
+            'hash': content_hash,
+            'etag': etag,
+            'last_modified': last_modified,
+            'seen_at': int(time.time()),
+        })
+
+        if previous is None:
+            self.index.stats.inc_value('incremental/new_items')
+        elif previous.get('hash') == content_hash:
+            self.index.stats.inc_value('incremental/unchanged_items')
+            raise DropItem(f'Unchanged item: {key}')
+        else:
+            self.index.stats.inc_value('incremental/changed_items')
+        return item
+'''
+
+
+##########################################
+# feed_export.py
+##########################################
+FEED_EXPORT_FORMATS = ['jsonl.gz', 'jsonl.zst', 'parquet']
+
+
+def create_feed_export_py(dst, feed_format):
+    """
+    Creates feed_export.py file with the key-value store feed storage
+    :param dst: directory in which file is created
+    :param feed_format: one of FEED_EXPORT_FORMATS
+    :return: boolean of successfulness
+    """
+    try:
+        feed_export_py = open(os.path.join(dst, "feed_export.py"), "w")
+        feed_export_py.write(get_feed_export_py_content(feed_format))
+        feed_export_py.close()
+        print('Created feed_export.py')
+    except FileExistsError:
+        print("Tried to create file 'feed_export.py', but file already exists.")
+        return False
+    return True
+
+
+def get_feed_export_settings(feed_format, batch_item_count=100000):
+    """
+    Returns scrapy settings which export items to chunks in the default key-value store
+    :param feed_format: one of FEED_EXPORT_FORMATS
+    :param batch_item_count: number of items in one chunk
+    :return: dictionary of scrapy settings
+    """
+    feed_options = {'batch_item_count': batch_item_count}
+
+    if feed_format == 'parquet':
+        feed_options['format'] = 'parquet'
+    else:
+        feed_options['format'] = 'jsonlines'
+        if feed_format == 'jsonl.gz':
+            feed_options['postprocessing'] = ['scrapy.extensions.postprocessing.GzipPlugin']
+        else:
+            feed_options['postprocessing'] = ['feed_export.ZstdPlugin']
+
+    return {
+        'FEED_STORAGES': {'apify-kvs': 'feed_export.KeyValueStoreFeedStorage'},
+        'FEED_EXPORTERS': {'parquet': 'feed_export.ParquetItemExporter'} if feed_format == 'parquet' else {},
+        'FEEDS': {f'apify-kvs://default/items-%(batch_id)05d.{feed_format}': feed_options},
+        'FEED_MANIFEST_KEY': 'FEED_MANIFEST',
+    }
+
+
+def get_feed_export_py_content(feed_format):
+    """
+    Returns content for feed_export.py. Only the code needed by the format is generated,
+    so pipreqs does not add unused compression libraries to requirements.txt
+    :param feed_format: one of FEED_EXPORT_FORMATS
+    :return: str of feed_export.py content
+    """
+    imports = ['from apify_platform import get_platform_client']
+    extra = ''
+    if feed_format == 'jsonl.zst':
+        imports.append('import zstandard')
+        extra = get_feed_export_zstd_content()
+    elif feed_format == 'parquet':
+        imports.extend(['import pyarrow', 'import pyarrow.parquet', 'from scrapy.exporters import BaseItemExporter'])
+        extra = get_feed_export_parquet_content()
+    imports.append('from scrapy.extensions.feedexport import BlockingFeedStorage')
+    imports = '\n'.join(imports)
+
+    return f'''import os
+import threading
+import time
+from urllib.parse import urlparse
+
+{imports}
+
+CONTENT_TYPES = {{
+    '.gz': 'application/gzip',
+    '.zst': 'application/zstd',
+    '.parquet': 'application/vnd.apache.parquet',
+    '.jsonl': 'application/jsonl',
+}}
+
+
+def get_feed_manifest(crawler):
+    """
+    Returns manifest shared by all feed storages of one crawler
+    """
+    manifest = getattr(crawler, 'feed_manifest', None)
+    if manifest is None:
+        manifest = FeedManifest(crawler.settings.get('FEED_MANIFEST_KEY', 'FEED_MANIFEST'))
+        crawler.feed_manifest = manifest
+    return manifest
+
+
+def get_store_id(store):
+    """
+    Returns id of the key-value store. 'default' is the default store of the run, other values are store names
+    """
+    if store == 'default':
+        return os.environ['APIFY_DEFAULT_KEY_VALUE_STORE_ID']
+    return get_platform_client().get_or_create_store(store)
+
+
+class FeedManifest:
+    """
+    Record listing every uploaded chunk. It is rewritten after each chunk, so it is valid even if the run fails
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.parts = []
+        self.lock = threading.Lock()
+
+    def add_part(self, store_id, part):
+        with self.lock:
+            self.parts.append(part)
+            get_platform_client().set_record(store_id, self.key, {{'parts': self.parts, 'updatedAt': int(time.time())}})
+
+
+class KeyValueStoreFeedStorage(BlockingFeedStorage):
+    """
+    Feed storage for apify-kvs://STORE/KEY uris. Every chunk is buffered in a temporary file,
+    uploaded as one record and closed, so memory is bounded by the chunk size
+    """
+
+    def __init__(self, uri, *, feed_options=None, manifest=None):
+        parsed = urlparse(uri)
+        self.store_name = parsed.netloc or 'default'
+        self.key = parsed.path.lstrip('/')
+        self.manifest = manifest or FeedManifest('FEED_MANIFEST')
+
+    @classmethod
+    def from_crawler(cls, crawler, uri, *, feed_options=None):
+        return cls(uri, feed_options=feed_options, manifest=get_feed_manifest(crawler))
+
+    def _store_in_thread(self, file):
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+
+        content_type = CONTENT_TYPES.get(os.path.splitext(self.key)[1], 'application/octet-stream')
+        store_id = get_store_id(self.store_name)
+        get_platform_client().set_record(store_id, self.key, file.read(), content_type=content_type)
+        file.close()
+
+        self.manifest.add_part(store_id, {{'key': self.key, 'size': size, 'contentType': content_type}})
+{extra}'''
+
+
+def get_feed_export_zstd_content():
+    """
+    Returns the zstd postprocessing plugin of feed_export.py
+    :return: str of the feed_export.py part
+    """
+    return '''
+
+class ZstdPlugin:
+    """
+    Feed postprocessing plugin compressing the feed with zstd. Level is set by 'zstd_compresslevel' feed option
+    """
+
+    def __init__(self, file, feed_options):
+        self.file = file
+        compressor = zstandard.ZstdCompressor(level=feed_options.get('zstd_compresslevel', 3))
+        self.writer = compressor.stream_writer(file, closefd=False)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+'''
+
+
+def get_feed_export_parquet_content():
+    """
+    Returns the parquet item exporter of feed_export.py
+    :return: str of the feed_export.py part
+    """
+    return '''
+
+class ParquetItemExporter(BaseItemExporter):
+    """
+    Writes items of one chunk as a parquet file. Items are kept in memory until the chunk is finished,
+    so use 'batch_item_count' feed option to bound the memory
+    """
+
+    def __init__(self, file, **kwargs):
+        self.compression = kwargs.pop('compression', 'zstd')
+        super().__init__(dont_fail=True, **kwargs)
+        self.file = file
+        self.rows = []
+
+    def export_item(self, item):
+        self.rows.append(dict(self._get_serialized_fields(item)))
+
+    def finish_exporting(self):
+        table = pyarrow.Table.from_pylist(self.rows)
+        pyarrow.parquet.write_table(table, self.file, compression=self.compression)
+        self.rows = []
+'''
+
+
+##########################################
+# adaptive_concurrency.py
+##########################################
+def create_adaptive_concurrency_py(dst):
+    """
+    Creates adaptive_concurrency.py file with middleware which tunes concurrency of each domain
+    :param dst: directory in which file is created
+    :return: boolean of successfulness
+    """
+    try:
+        adaptive_concurrency_py = open(os.path.join(dst, "adaptive_concurrency.py"), "w")
+        adaptive_concurrency_py.write(get_adaptive_concurrency_py_content())
+        adaptive_concurrency_py.close()
+        print('Created adaptive_concurrency.py')
+    except FileExistsError:
+        print("Tried to create file 'adaptive_concurrency.py', but file already exists.")
+        return False
+    return True
+
+
+# the largest memory of an actor on Apify platform
+APIFY_MAX_MEMORY_MBYTES = 32768
+
+
+def get_adaptive_concurrency_settings(max_concurrency=64, mb_per_request=16):
+    """
+    Returns scrapy settings which enable adaptive concurrency in main.py. AutoThrottle is disabled, because it would
+    fight the controller over download delays. Static limits of scrapy are raised to the caps of the controller, the
+    global cap is lowered to the memory of the actor in runtime
+    :param max_concurrency: the highest concurrency of one domain
+    :param mb_per_request: memory reserved for one concurrent request in megabytes
+    :return: dictionary of scrapy settings
+    """
+    return {
+        'DOWNLOADER_MIDDLEWARES': {'adaptive_concurrency.AdaptiveConcurrencyMiddleware': 960},
+        'AUTOTHROTTLE_ENABLED': False,
+        'CONCURRENT_REQUESTS': APIFY_MAX_MEMORY_MBYTES // mb_per_request,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': max_concurrency,
+        'ADAPTIVE_CONCURRENCY_START': 2,
+        'ADAPTIVE_CONCURRENCY_MIN': 1,
+        'ADAPTIVE_CONCURRENCY_MAX': max_concurrency,
+        'ADAPTIVE_CONCURRENCY_DECREASE_FACTOR': 0.5,
+        'ADAPTIVE_CONCURRENCY_LATENCY_FACTOR': 3.0,
+        'ADAPTIVE_CONCURRENCY_ERROR_RATE': 0.2,
+        'ADAPTIVE_CONCURRENCY_MB_PER_REQUEST': mb_per_request,
+    }
+
+
+def get_adaptive_concurrency_py_content():
+    """
+    Returns content for adaptive_concurrency.py
+    :return: str of adaptive_concurrency.py content
+    """
+    return '''import logging
+import os
+import time
+from email.utils import parsedate_to_datetime
+
+from scrapy import signals
+
+# responses which mean that the site is rate limiting us
+RATE_LIMIT_STATUSES = {429, 503}
+
+# weight of the newest observation in moving averages
+EWMA_WEIGHT = 0.1
+
+# latency growth in seconds which is ignored, so jitter of fast sites does not decrease concurrency
+LATENCY_TOLERANCE = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+def get_memory_mbytes():
+    """
+    Returns memory of the actor in megabytes or None when not running on Apify platform
+    """
+    memory = os.environ.get('ACTOR_MEMORY_MBYTES') or os.environ.get('APIFY_MEMORY_MBYTES')
+    return int(memory) if memory else None
+
+
+def parse_retry_after(value):
+    """
+    Parses Retry-After header, which is either a number of seconds or a HTTP date
+    :return: number of seconds or None
+    """
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class DomainState:
+    """
+    State of the controller for one downloader slot
+    """
+
+    def __init__(self, slot, concurrency):
+        self.slot = slot
+        self.concurrency = concurrency
+        self.increase = 0.0
+        self.latency = None
+        self.best_latency = None
+        self.error_rate = 0.0
+        self.last_decrease = 0.0
+        self.original_delay = slot.delay
+        self.delay_until = 0.0
+        self.responses = 0
+        self.started = time.monotonic()
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    Tunes concurrency of each downloader slot (domain by default) with AIMD rule. Concurrency is increased by one
+    after a window of successful responses and multiplied by ADAPTIVE_CONCURRENCY_DECREASE_FACTOR when the site
+    returns 429 or 503, the error rate or the latency grows. Retry-After header pauses the slot. Concurrency of a slot
+    is capped by CONCURRENT_REQUESTS_PER_DOMAIN, sum of concurrencies of slots with requests in progress by
+    CONCURRENT_REQUESTS and the memory of the actor
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.start = settings.getint('ADAPTIVE_CONCURRENCY_START', 2)
+        self.min = settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1)
+        # connection pool of HTTP/1.1 handler keeps CONCURRENT_REQUESTS_PER_DOMAIN connections per host, more
+        # concurrent requests would open new connections
+        self.max = min(settings.getint('ADAPTIVE_CONCURRENCY_MAX', 64),
+                       settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'))
+        self.decrease_factor = settings.getfloat('ADAPTIVE_CONCURRENCY_DECREASE_FACTOR', 0.5)
+        self.latency_factor = settings.getfloat('ADAPTIVE_CONCURRENCY_LATENCY_FACTOR', 3.0)
+        self.max_error_rate = settings.getfloat('ADAPTIVE_CONCURRENCY_ERROR_RATE', 0.2)
+        self.max_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_RETRY_AFTER', 120)
+
+        self.global_cap = settings.getint('CONCURRENT_REQUESTS')
+        memory = get_memory_mbytes()
+        if memory:
+            mb_per_request = settings.getint('ADAPTIVE_CONCURRENCY_MB_PER_REQUEST', 16)
+            self.global_cap = min(self.global_cap, max(self.min, memory // mb_per_request))
+
+        self.states = {}
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.crawler.engine.downloader.total_concurrency = self.global_cap
+        self.crawler.stats.set_value('adaptive_concurrency/global_cap', self.global_cap)
+        logger.info(f'Adaptive concurrency: global cap is {self.global_cap} concurrent requests')
+
+    def spider_closed(self, spider):
+        for key, state in self.states.items():
+            elapsed = max(time.monotonic() - state.started, 1e-6)
+            self.crawler.stats.set_value(f'adaptive_concurrency/{key}/throughput', round(state.responses / elapsed, 2))
+
+    def get_state(self, request):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return key, None, None
+
+        state = self.states.get(key)
+        if state is None:
+            state = DomainState(slot, min(self.start, self.max))
+            self.states[key] = state
+            slot.concurrency = state.concurrency
+        elif state.slot is not slot:
+            # idle slots are garbage collected by scrapy, the recreated slot continues with the learned concurrency
+            state.slot = slot
+            state.original_delay = slot.delay
+            state.delay_until = 0.0
+            slot.concurrency = state.concurrency
+        return key, slot, state
+
+    def request_reached_downloader(self, request, spider):
+        # the slot is assigned to the request after downloader middlewares, but before it is downloaded
+        self.get_state(request)
+
+    def process_response(self, request, response, spider):
+        key, slot, state = self.get_state(request)
+        if state is None:
+            return response
+
+        state.responses += 1
+        self.crawler.stats.inc_value(f'adaptive_concurrency/{key}/responses')
+
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            state.latency = latency if state.latency is None else \\
+                (1 - EWMA_WEIGHT) * state.latency + EWMA_WEIGHT * latency
+            state.best_latency = state.latency if state.best_latency is None else \\
+                min(state.best_latency, state.latency)
+
+        is_error = response.status in RATE_LIMIT_STATUSES or response.status >= 500
+        state.error_rate = (1 - EWMA_WEIGHT) * state.error_rate + EWMA_WEIGHT * is_error
+
+        if response.status in RATE_LIMIT_STATUSES:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after:
+                slot.delay = min(retry_after, self.max_delay)
+                state.delay_until = time.monotonic() + slot.delay
+            self.decrease(key, slot, state, spider, force=True)
+        elif state.error_rate > self.max_error_rate:
+            self.decrease(key, slot, state, spider)
+        elif state.best_latency and state.latency > max(self.latency_factor * state.best_latency,
+                                                        state.best_latency + LATENCY_TOLERANCE):
+            self.decrease(key, slot, state, spider)
+        elif not is_error:
+            self.additive_increase(key, slot, state, spider)
+
+        if state.delay_until and time.monotonic() >= state.delay_until:
+            slot.delay = state.original_delay
+            state.delay_until = 0.0
+        return response
+
+    def process_exception(self, request, exception, spider):
+        key, slot, state = self.get_state(request)
+        if state is not None:
+            state.error_rate = (1 - EWMA_WEIGHT) * state.error_rate + EWMA_WEIGHT
+            if state.error_rate > self.max_error_rate:
+                self.decrease(key, slot, state, spider)
+        return None
+
+    def additive_increase(self, key, slot, state, spider):
+        # one whole step per window of `concurrency` successful responses
+        state.increase += 1 / state.concurrency
+        if state.increase < 1:
+            return
+        state.increase = 0.0
+
+        if state.concurrency >= self.max or self.get_total_concurrency() >= self.global_cap:
+            return
+        self.set_concurrency(key, slot, state, state.concurrency + 1, spider)
+
+    def decrease(self, key, slot, state, spider, force=False):
+        # decrease at most once per latency window, responses of requests sent before the decrease are ignored
+        # rate limit responses are trusted more, so their window is shorter
+        window = state.latency or 1
+        now = time.monotonic()
+        if now - state.last_decrease < (window / 2 if force else window):
+            return
+        state.last_decrease = now
+        state.increase = 0.0
+        self.crawler.stats.inc_value(f'adaptive_concurrency/{key}/decreases')
+        self.set_concurrency(key, slot, state, max(self.min, int(state.concurrency * self.decrease_factor)), spider)
+
+    def set_concurrency(self, key, slot, state, concurrency, spider):
+        state.concurrency = concurrency
+        slot.concurrency = concurrency
+        self.crawler.stats.set_value(f'adaptive_concurrency/{key}/concurrency', concurrency)
+        self.crawler.stats.max_value(f'adaptive_concurrency/{key}/max_concurrency', concurrency)
+
+    def get_total_concurrency(self):
+        # only slots with active or queued requests take memory, finished domains do not count
+        slots = self.crawler.engine.downloader.slots
+        return sum(state.concurrency for key, state in self.states.items()
+                   if key in slots and slots[key].active)
+'''
+
+
+##########################################
+# proxy_sessions.py
+##########################################
+def create_proxy_sessions_py(dst):
+    """
+    Creates proxy_sessions.py file with middleware which manages a pool of sticky proxy sessions
+    :param dst: directory in which file is created
+    :return: boolean of successfulness
+    """
+    try:
+        proxy_sessions_py = open(os.path.join(dst, "proxy_sessions.py"), "w")
+        proxy_sessions_py.write(get_proxy_sessions_py_content())
+        proxy_sessions_py.close()
+        print('Created proxy_sessions.py')
+    except FileExistsError:
+        print("Tried to create file 'proxy_sessions.py', but file already exists.")
+        return False
+    return True
+
+
+def get_proxy_sessions_settings():
+    """
+    Returns scrapy settings which enable proxy sessions in main.py. The middleware runs before HttpProxyMiddleware,
+    which turns credentials of the proxy url to the Proxy-Authorization header
+    :return: dictionary of scrapy settings
+    """
+    return {
+        'DOWNLOADER_MIDDLEWARES': {'proxy_sessions.ProxySessionMiddleware': 740},
+        'PROXY_SESSIONS_POOL_SIZE': 20,
+        'PROXY_SESSIONS_MAX_USAGE': 100,
+        'PROXY_SESSIONS_MIN_SCORE': 0.3,
+        'PROXY_SESSIONS_LATENCY_FACTOR': 3.0,
+        'PROXY_SESSIONS_BAN_STATUSES': [403, 429],
+        'PROXY_SESSIONS_MAX_RETRIES': 3,
+    }
+
+
+def get_proxy_sessions_py_content():
+    """
+    Returns content for proxy_sessions.py
+    :return: str of proxy_sessions.py content
+    """
+    return '''import json
+import logging
+import os
+import secrets
+from urllib.parse import urlparse
+
+from scrapy.exceptions import NotConfigured
+
+from apify_platform import get_proxy_password_future, get_proxy_url
+
+# scores of sessions are between 0 and 1, new session starts with 1
+SUCCESS_REWARD = 0.05
+SLOW_PENALTY = 0.9
+ERROR_PENALTY = 0.7
+BAN_PENALTY = 0.5
+
+# weight of the newest observation in moving average of latency of a session
+EWMA_WEIGHT = 0.3
+
+# responses of a session before its latency is trusted
+MIN_RESPONSES = 3
+
+# latency growth in seconds which is ignored, so jitter of fast sites does not look like a slow session
+LATENCY_TOLERANCE = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class ProxySession:
+    """
+    Sticky proxy session. Requests of the session go through the same IP address, so cookies stay valid and
+    connections to the proxy are kept alive and reused
+    """
+
+    def __init__(self, session_id, proxy_url):
+        self.id = session_id
+        self.proxy_url = proxy_url
+        self.score = 1.0
+        self.latency = None
+        self.responses = 0
+        self.usage = 0
+        self.domains = set()
+        # domains which blocked IP address of the session
+        self.banned_domains = set()
+
+
+class ProxySessionMiddleware:
+    """
+    Sets proxy of each request from a pool of sticky sessions. Each domain sticks to one session. Sessions are scored
+    by latency, errors and ban responses and evicted when the score drops below PROXY_SESSIONS_MIN_SCORE or after
+    PROXY_SESSIONS_MAX_USAGE requests. Banned requests are retried with another session. Proxy set by the spider in
+    request.meta is kept
+    """
+
+    def __init__(self, crawler, proxy_configuration):
+        self.stats = crawler.stats
+        settings = crawler.settings
+        self.proxy_configuration = proxy_configuration
+        self.pool_size = settings.getint('PROXY_SESSIONS_POOL_SIZE', 20)
+        self.max_usage = settings.getint('PROXY_SESSIONS_MAX_USAGE', 100)
+        self.min_score = settings.getfloat('PROXY_SESSIONS_MIN_SCORE', 0.3)
+        self.latency_factor = settings.getfloat('PROXY_SESSIONS_LATENCY_FACTOR', 3.0)
+        self.ban_statuses = {int(status) for status in settings.getlist('PROXY_SESSIONS_BAN_STATUSES', [403, 429])}
+        self.max_retries = settings.getint('PROXY_SESSIONS_MAX_RETRIES', 3)
+
+        # password is resolved when the first session is created, not in the reactor start up
+        self.proxy_password = get_proxy_password_future() if proxy_configuration.get('useApifyProxy') else None
+
+        # ids are unique across runs, so Apify Proxy does not reuse sessions of a previous run
+        self.prefix = secrets.token_hex(4)
+        self.created = 0
+        self.sessions = {}
+        self.domains = {}
+        # the best latency of a session seen so far, other sessions are compared to it
+        self.best_latency = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        proxy_configuration = json.loads(os.environ.get('PROXY_SESSIONS_CONFIGURATION') or 'null')
+        if not proxy_configuration or not (proxy_configuration.get('useApifyProxy')
+                                           or proxy_configuration.get('proxyUrls')):
+            raise NotConfigured('Proxy is not configured in the actor input')
+        return cls(crawler, proxy_configuration)
+
+    def process_request(self, request, spider):
+        session_id = request.meta.get('proxy_session')
+        if session_id is None and request.meta.get('proxy'):
+            return None
+
+        # retried and redirected requests keep their session while it is alive and not banned by the domain
+        domain = urlparse(request.url).hostname
+        session = self.sessions.get(session_id)
+        if session is None or domain in session.banned_domains:
+            session = self.get_session(domain)
+        session.usage += 1
+        request.meta['proxy_session'] = session.id
+        request.meta['proxy'] = session.proxy_url
+
+        if session.usage >= self.max_usage:
+            # requests already sent by the session still finish, only new requests get a new session
+            self.evict(session, 'usage')
+        return None
+
+    def process_response(self, request, response, spider):
+        if 'proxy_session' not in request.meta:
+            return response
+        session = self.sessions.get(request.meta['proxy_session'])
+
+        if response.status in self.ban_statuses:
+            # session can be already evicted by other banned requests sent at the same time
+            if session is not None:
+                self.ban(session, urlparse(request.url).hostname)
+            return self.retry(request, response)
+
+        if session is not None:
+            latency = request.meta.get('download_latency')
+            if latency is not None:
+                self.update_latency(session, latency)
+            if self.is_slow(session):
+                session.score *= SLOW_PENALTY
+            else:
+                session.score = min(1.0, session.score + SUCCESS_REWARD)
+            if session.score < self.min_score:
+                self.evict(session, 'score')
+        return response
+
+    def process_exception(self, request, exception, spider):
+        session = self.sessions.get(request.meta.get('proxy_session'))
+        if session is not None:
+            session.score *= ERROR_PENALTY
+            self.stats.inc_value('proxy_sessions/errors')
+            if session.score < self.min_score:
+                self.evict(session, 'score')
+        return None
+
+    def ban(self, session, domain):
+        session.score *= BAN_PENALTY
+        self.stats.inc_value('proxy_sessions/bans')
+        # IP address of the session is blocked by the domain, next requests of the domain get another session
+        session.banned_domains.add(domain)
+        if self.domains.get(domain) == session.id:
+            del self.domains[domain]
+            session.domains.discard(domain)
+        if session.score < self.min_score:
+            self.evict(session, 'score')
+
+    def retry(self, request, response):
+        retries = request.meta.get('proxy_session_retries', 0)
+        if retries >= self.max_retries:
+            return response
+        self.stats.inc_value('proxy_sessions/retries')
+        meta = {key: value for key, value in request.meta.items() if key not in ('proxy', 'proxy_session')}
+        meta['proxy_session_retries'] = retries + 1
+        return request.replace(meta=meta, dont_filter=True)
+
+    def get_session(self, domain):
+        session = self.sessions.get(self.domains.get(domain))
+        if session is not None:
+            return session
+
+        candidates = [session for session in self.sessions.values() if domain not in session.banned_domains]
+        if len(self.sessions) < self.pool_size:
+            session = self.create_session()
+        elif candidates:
+            # pool is full, the domain shares the healthiest of the sessions with the fewest domains
+            session = max(candidates, key=lambda s: (-len(s.domains), s.score))
+        else:
+            # every session is banned by the domain, the worst one is replaced
+            self.evict(min(self.sessions.values(), key=lambda s: s.score), 'banned')
+            session = self.create_session()
+        session.domains.add(domain)
+        self.domains[domain] = session.id
+        return session
+
+    def create_session(self):
+        session_id = f'{self.prefix}_{self.created}'
+        # with proxyUrls, each new session goes to the next url
+        proxy_url = get_proxy_url(self.proxy_configuration, self.proxy_password, session_id, self.created)
+        self.created += 1
+
+        session = ProxySession(session_id, proxy_url)
+        self.sessions[session_id] = session
+        self.stats.inc_value('proxy_sessions/created')
+        return session
+
+    def evict(self, session, reason):
+        if self.sessions.pop(session.id, None) is None:
+            return
+        for domain in session.domains:
+            if self.domains.get(domain) == session.id:
+                del self.domains[domain]
+        self.stats.inc_value(f'proxy_sessions/evicted/{reason}')
+        logger.debug(f'Proxy session {session.id} evicted ({reason}), score {session.score:.2f}, '
+                     f'{session.usage} requests')
+
+    def update_latency(self, session, latency):
+        session.responses += 1
+        session.latency = latency if session.latency is None else \\
+            (1 - EWMA_WEIGHT) * session.latency + EWMA_WEIGHT * latency
+        if session.responses >= MIN_RESPONSES:
+            self.best_latency = session.latency if self.best_latency is None else \\
+                min(self.best_latency, session.latency)
+
+    def is_slow(self, session):
+        if session.responses < MIN_RESPONSES or self.best_latency is None:
+            return False
+        return session.latency > max(self.latency_factor * self.best_latency, self.best_latency + LATENCY_TOLERANCE)
+'''
 
 
 ##########################################
 # INPUT_SCHEMA.json
 ##########################################
-def create_input_schema(dst, name, inputs):
+def create_input_schema(dst, name, inputs, proxy_sessions=False):
     """
     Creates apify.json file and fills it with content
     :param dst: directory in which file is created
     :param name: name of the spider
     :param inputs: inputs of the spider
+    :param proxy_sessions: if True, inputs of the proxy session middleware are added
     :return: boolean of successfulness
     """
     try:
         input_schema = open(os.path.join(dst, "INPUT_SCHEMA.json"), "w")
-        content = get_input_schema_content(name, inputs)
+        content = get_input_schema_content(name, inputs, proxy_sessions)
         input_schema.write(content)
         input_schema.close()
         print('Created INPUT_SCHEMA.json')
@@ -213,19 +1665,24 @@ def create_input_schema(dst, name, inputs):
     return True
 
 
-def get_input_schema_content(name, inputs):
+def get_input_schema_content(name, inputs, proxy_sessions=False):
     """
     Returns content for INPUT_SCHEMA.json
     :param name: name of the module with spider class
     :param inputs: inputs to be defined
+    :param proxy_sessions: if True, inputs of the proxy session middleware are added
     :return: str of INPUT_SCHEMA.json content
     """
+    properties = get_properties(inputs)
+    if proxy_sessions:
+        properties += get_proxy_sessions_properties()
+
     return f"""{{
     "title": "{name} input",
     "type": "object",
     "schemaVersion": 1,
     "properties": {{
-        {get_properties(inputs)[:-1]}
+        {properties[:-1]}
     }}
 }}"""
 
@@ -258,18 +1715,49 @@ def get_properties(inputs):
     return properties
 
 
+def get_proxy_sessions_properties():
+    """
+    Creates properties read by main.py which configure the proxy session middleware
+    :return: str of properties
+    """
+    return """"proxyConfiguration": {
+            "title": "Proxy configuration",
+            "type": "object",
+            "editor": "proxy",
+            "description": "Proxy servers of the spider. Each domain sticks to one proxy session",
+            "prefill": {"useApifyProxy": true}
+        },"proxySessionPoolSize": {
+            "title": "Proxy session pool size",
+            "type": "integer",
+            "editor": "number",
+            "description": "Maximum number of proxy sessions used at the same time",
+            "minimum": 1,
+            "default": 20
+        },"proxySessionMaxUsage": {
+            "title": "Proxy session max usage",
+            "type": "integer",
+            "editor": "number",
+            "description": "Number of requests after which a proxy session is replaced by a new one",
+            "minimum": 1,
+            "default": 100
+        },"""
+
+
 ##########################################
 # apify.json
 ##########################################
-def create_apify_json(dst: str):
+def create_apify_json(dst: str, name=None):
     """
     Creates apify.json file and fills it with content
     :param dst: directory in which file is created
+    :param name: name of the project. If None, it is read from scrapy.cfg in dst
     :return: boolean of successfulness
     """
     try:
+        content = get_apify_json_content(dst, name)
+        if content is None:
+            return False
         apify_json = open(os.path.join(dst, "apify.json"), "w")
-        content = get_apify_json_content(dst)
 
         apify_json.write(content)
         apify_json.close()
@@ -280,31 +1768,47 @@ def create_apify_json(dst: str):
     return True
 
 
-def get_apify_json_content(dst):
+def get_apify_json_content(dst, name=None):
     """
     Creates content for apify.json. Reads scrapy.cfg file in @dst folder and finds for a name
     :param dst: directory in which scrapy.cfg is located
+    :param name: name of the project. If None, it is read from scrapy.cfg
     :return: str of apify.json content
     """
+    if name is None:
+        name = get_project_name(dst)
+        if name is None:
+            return None
+
+    return f"""{{
+        "name": "{name}",
+        "version": "0.1",
+        "buildTag": "latest",
+        "env": null
+}}"""
+
+
+def get_project_name(dst):
+    """
+    Reads scrapy.cfg file in @dst folder and finds a project name in [deploy] section
+    :param dst: directory in which scrapy.cfg is located
+    :return: str of the name or None if scrapy.cfg does not exist
+    """
     try:
         cfg = open(os.path.join(dst, "scrapy.cfg"), "r")
         line = cfg.readline()
         name = ""
-        while line is not None and "[deploy]" not in line:
+        while line and "[deploy]" not in line:
             line = cfg.readline()
 
-        while line is not None and "project =" not in line:
+        while line and "project =" not in line:
             line = cfg.readline()
 
-        if line is not None:
+        if line:
             name = line.split("=")[1].strip()
+        cfg.close()
 
-        return f"""{{
-        "name": "{name}",
-        "version": "0.1",
-        "buildTag": "latest",
-        "env": null
-}}"""
+        return name
     except FileNotFoundError:
         print('Could not find "scrapy.cfg" file.')
         return None
@@ -313,15 +1817,16 @@ def get_apify_json_content(dst):
 ##########################################
 # Dockerfile
 ##########################################
-def create_dockerfile(dst):
+def create_dockerfile(dst, runtime='cpython'):
     """
     Creates Dockerfile file and fills it with content
     :param dst: directory in which file is created
+    :param runtime: interpreter the actor is built for, one of RUNTIMES
     :return: boolean of successfulness
     """
     try:
         apify_json = open(os.path.join(dst, "Dockerfile"), "w")
-        apify_json.write(get_dockerfile_content())
+        apify_json.write(get_dockerfile_content(runtime))
         apify_json.close()
         print('Created Dockerfile')
     except FileExistsError:
@@ -330,16 +1835,51 @@ def create_dockerfile(dst):
     return True
 
 
-def get_dockerfile_content():
+def get_dockerfile_runtime(dst):
+    """
+    Returns runtime of the Dockerfile in a directory by its base image
+    :param dst: directory with Dockerfile
+    :return: one of RUNTIMES, 'cpython' if there is no Dockerfile
+    """
+    dockerfile = os.path.join(dst, 'Dockerfile')
+    if not os.path.exists(dockerfile):
+        return 'cpython'
+
+    with open(dockerfile, 'r') as file:
+        for line in file:
+            if line.strip().upper().startswith('FROM '):
+                return 'pypy' if 'pypy' in line.lower() else 'cpython'
+    return 'cpython'
+
+
+def get_dockerfile_content(runtime='cpython'):
     """
     Returns content for Dockerfile
+    :param runtime: interpreter the actor is built for, one of RUNTIMES
     :return: str of Dockerfile content
     """
+    if runtime == 'pypy':
+        # there is no Apify image with PyPy, official PyPy image is used
+        base_image = 'pypy:3.10-slim'
+        python = 'pypy3'
+        pip = 'pypy3 -m pip'
+        command = 'pypy3 main.py'
+        workdir = """
+# PyPy image has no working directory set
+WORKDIR /usr/src/app
+"""
+    else:
+        base_image = 'apify/actor-python:3.9'
+        python = 'python'
+        pip = 'pip'
+        command = 'python3 main.py'
+        workdir = ''
+
     return f"""# First, specify the base Docker image.
 # You can see the Docker images from Apify at https://hub.docker.com/r/apify/.
 # You can also use any other image from Docker Hub.
-FROM apify/actor-python:3.9
-
+FROM {base_image}
+{workdir}
 # Second, copy just requirements.txt into the actor image,
 # since it should be the only file that affects "pip install" in the next step,
 # in order to speed up the build
@@ -349,13 +1889,13 @@ COPY requirements.txt ./
 # Print the installed Python version, pip version
 # and all installed packages with their versions for debugging
 RUN echo "Python version:" \
- && python --version \
+ && {python} --version \
  && echo "Pip version:" \
- && pip --version \
+ && {pip} --version \
  && echo "Installing dependencies from requirements.txt:" \
- && pip install -r requirements.txt \
+ && {pip} install -r requirements.txt \
  && echo "All installed Python packages:" \
- && pip freeze
+ && {pip} freeze
 
 # Next, copy the remaining files and directories with the source code.
 # Since we do this after installing the dependencies, quick build will be really fast
@@ -364,7 +1904,7 @@ COPY . ./
 
 # Specify how to launch the source code of your actor.
 # By default, the main.py file is run
-CMD python3 main.py
+CMD {command}
 """
 
 
@@ -0,0 +1,611 @@
+import base64
+import contextlib
+import json
+import os
+import platform
+import shutil
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+# injected to the actor by MIGRATOR_EXTRA_SETTINGS, so every request goes to the mock website
+LOAD_TEST_SETTINGS = {
+    'DOWNLOAD_HANDLERS': {'http': 'load_test.MockSiteDownloadHandler', 'https': 'load_test.MockSiteDownloadHandler'},
+    'SPIDER_MIDDLEWARES': {'load_test.CallbackTimer': 1000},
+    'EXTENSIONS': {'load_test.StatsDump': 0},
+    'ROBOTSTXT_OBEY': False,
+    'TELNETCONSOLE_ENABLED': False,
+}
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    HTTP server of the mocks. Listen backlog is raised, so connections of highly concurrent actors are not dropped
+    """
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def load_test(actor_dirs, pages=1000, latency=0.05, error_rate=0.0, settings_variants=None, actor_input=None,
+              interpreters=None, proxy_bad_exits=None, memory_mbytes=4096, timeout=600):
+    """
+    Runs migrated actors locally against a mock website and a stand-in of Apify API and prints their performance
+    :param actor_dirs: directories with main.py created by wrap_scrapy
+    :param pages: number of unique pages of the mock website
+    :param latency: mean latency of the mock website in seconds
+    :param error_rate: ratio of responses of the mock website which are 500 or 503 with Retry-After
+    :param settings_variants: array of dictionaries of scrapy settings, each actor is run with each variant
+    :param actor_input: dictionary of the actor input
+    :param interpreters: array of python interpreters, e.g. 'pypy3', each actor is run with each of them.
+    Defaults to the current interpreter
+    :param proxy_bad_exits: ratio of banned or slow exits of the proxy stand-in, None to run without proxy
+    :param memory_mbytes: memory of the actor passed by APIFY_MEMORY_MBYTES
+    :param timeout: maximum duration of one run in seconds
+    :return: array of dictionaries with results of each run
+    """
+    results = []
+
+    for interpreter in interpreters or []:
+        if shutil.which(interpreter) is None:
+            print(f'Could not find interpreter {interpreter}.')
+            return results
+
+    for actor_dir in actor_dirs:
+        if not os.path.exists(os.path.join(actor_dir, 'main.py')):
+            print(f'Could not find main.py in {actor_dir}. Migrate the project first.')
+            continue
+
+        for interpreter in interpreters or [sys.executable]:
+            for settings in settings_variants or [{}]:
+                site = MockSite(pages, latency, error_rate)
+                proxy = MockProxy(proxy_bad_exits) if proxy_bad_exits is not None else None
+                run_input = dict(actor_input or {})
+                if proxy:
+                    run_input.setdefault('proxyConfiguration', {'useApifyProxy': True})
+                api = MockApi(run_input)
+                with site, api, proxy or contextlib.nullcontext():
+                    result = run_actor(actor_dir, site, api, proxy, settings, interpreter, memory_mbytes, timeout)
+                results.append(result)
+                print_result(result)
+
+    return results
+
+
+def run_actor(actor_dir, site, api, proxy, settings, interpreter, memory_mbytes, timeout):
+    """
+    Runs main.py of an actor and measures it
+    :return: dictionary with results of the run
+    """
+    stats_file = tempfile.NamedTemporaryFile(prefix='load-test-stats-', suffix='.json', delete=False)
+    stats_file.close()
+
+    extra_settings = json.loads(json.dumps(LOAD_TEST_SETTINGS))
+    for key, value in settings.items():
+        if isinstance(value, dict) and isinstance(extra_settings.get(key), dict):
+            extra_settings[key].update(value)
+        else:
+            extra_settings[key] = value
+
+    env = dict(os.environ)
+    env.update({
+        'APIFY_TOKEN': 'load-test',
+        'APIFY_API_BASE_URL': api.url,
+        'APIFY_DEFAULT_KEY_VALUE_STORE_ID': 'default',
+        'APIFY_DEFAULT_DATASET_ID': 'default',
+        'APIFY_INPUT_KEY': 'INPUT',
+        'APIFY_PROXY_PASSWORD': 'load-test',
+        'APIFY_MEMORY_MBYTES': str(memory_mbytes),
+        'MIGRATOR_EXTRA_SETTINGS': json.dumps(extra_settings),
+        'LOAD_TEST_SITE_URL': site.url,
+        'LOAD_TEST_STATS_FILE': stats_file.name,
+        'PYTHONPATH': os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                    env.get('PYTHONPATH')])),
+    })
+    for variable in ['http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY']:
+        env.pop(variable, None)
+    if proxy:
+        env.update({'APIFY_PROXY_HOSTNAME': '127.0.0.1', 'APIFY_PROXY_PORT': str(proxy.port)})
+
+    start = time.monotonic()
+    process = subprocess.Popen([interpreter, 'main.py'], cwd=actor_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.extend(process.stderr), daemon=True)
+    reader.start()
+
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    peak_rss_mb = None
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    else:
+        process.wait()
+    timer.cancel()
+    reader.join(5)
+    duration = time.monotonic() - start
+
+    with open(stats_file.name, 'r') as file:
+        content = file.read()
+    os.remove(stats_file.name)
+    stats = json.loads(content) if content else {}
+
+    crawl_duration = max(duration - (site.first_request_at - start if site.first_request_at else 0), 1e-6)
+    items = stats.get('item_scraped_count', api.dataset_items)
+
+    # an actor which exits with 0 without crawling, e.g. because the spider could not be loaded, failed as well
+    failure = None
+    if process.returncode != 0:
+        failure = f'exit code {process.returncode}'
+    elif not stats:
+        failure = 'stats of the crawl were not dumped'
+    elif not site.requests:
+        failure = 'no request reached the mock website'
+    if failure:
+        print(b''.join(stderr[-30:]).decode('utf-8', errors='replace'))
+
+    return {
+        'actor': actor_dir,
+        'settings': settings,
+        'python': stats.get('load_test/python', interpreter),
+        'exit_code': process.returncode,
+        'failure': failure,
+        'duration': duration,
+        'startup_time': site.first_request_at - start if site.first_request_at else None,
+        'items': items,
+        'items_per_second': items / crawl_duration,
+        'requests': site.requests,
+        'requests_per_second': site.requests / crawl_duration,
+        'errors_injected': site.errors,
+        'dataset_items': api.dataset_items,
+        'api_calls': api.calls,
+        'peak_rss_mb': peak_rss_mb,
+        'callback_cpu_time': stats.get('load_test/callback_cpu_time'),
+        'callback_count': stats.get('load_test/callback_count', 0),
+        'proxy': proxy.get_stats() if proxy else None,
+        'stats': stats,
+    }
+
+
+def print_result(result):
+    """
+    Prints results of one run
+    :param result: dictionary from run_actor
+    """
+    print(f"{result['actor']} {json.dumps(result['settings']) if result['settings'] else ''}")
+    print(f"  python:        {result['python']}")
+    print(f"  exit code:     {result['exit_code']}")
+    if result['failure']:
+        print(f"  failed:        {result['failure']}")
+    if result['startup_time'] is not None:
+        print(f"  startup time:  {result['startup_time']:.2f}s")
+    print(f"  duration:      {result['duration']:.2f}s")
+    print(f"  items:         {result['items']} ({result['items_per_second']:.1f} items/s)")
+    print(f"  requests:      {result['requests']} ({result['requests_per_second']:.1f} requests/s, "
+          f"{result['errors_injected']} errors injected)")
+    print(f"  api calls:     {result['api_calls']}")
+    if result['peak_rss_mb'] is not None:
+        print(f"  peak RSS:      {result['peak_rss_mb']:.1f} MB")
+    if result['proxy']:
+        proxy = result['proxy']
+        print(f"  proxy:         {proxy['requests']} requests over {proxy['connections']} connections, "
+              f"{proxy['sessions']} sessions, {proxy['bans']} bans")
+    if result['callback_cpu_time'] is not None:
+        per_callback = result['callback_cpu_time'] / max(result['callback_count'], 1)
+        print(f"  callback CPU:  {result['callback_cpu_time']:.2f}s ({per_callback * 1000:.2f} ms per response)")
+
+
+##########################################
+# mock website
+##########################################
+class MockSite:
+    """
+    Local website with a fixed number of pages. Every page links to other pages, so any spider following links
+    crawls the whole site. Latency and errors are injected
+    """
+
+    def __init__(self, pages, latency, error_rate, links_per_page=10):
+        self.pages = max(1, pages)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.links_per_page = links_per_page
+        self.requests = 0
+        self.errors = 0
+        self.first_request_at = None
+        self.lock = threading.Lock()
+        self.server = MockServer(('127.0.0.1', 0), self.get_handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_page_index(self, path):
+        match = re.match('^/page/([0-9]+)$', path)
+        if match:
+            return int(match.group(1)) % self.pages
+        return zlib.crc32(path.encode('utf-8')) % self.pages
+
+    def get_page(self, index):
+        links = ''.join(f'<li><a href="/page/{(index * 7 + i) % self.pages}">Page {(index * 7 + i) % self.pages}'
+                        f'</a></li>' for i in range(1, self.links_per_page + 1))
+        return f"""<!DOCTYPE html>
+<html><head><title>Page {index}</title></head>
+<body>
+<h1>Page {index}</h1>
+<p class="description">Content of the page {index}. {'Lorem ipsum dolor sit amet. ' * 20}</p>
+<span class="price">{index % 1000}.99</span>
+<ul>{links}</ul>
+</body></html>""".encode('utf-8')
+
+    def get_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with site.lock:
+                    site.requests += 1
+                    if site.first_request_at is None:
+                        site.first_request_at = time.monotonic()
+
+                if site.latency:
+                    time.sleep(random.uniform(0.5, 1.5) * site.latency)
+
+                if random.random() < site.error_rate:
+                    with site.lock:
+                        site.errors += 1
+                    status = random.choice([500, 503])
+                    self.send_response(status)
+                    if status == 503:
+                        self.send_header('Retry-After', '1')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                index = site.get_page_index(urlparse(self.path).path)
+                body = site.get_page(index)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', f'"{index}"')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class MockSiteDownloadHandler:
+    """
+    Download handler injected to the actor which downloads every request from the mock website, path is kept. The
+    request is rewritten only for the download, so scheduler, downloader slots and middlewares see the original url
+    and each domain of the spider keeps its own slot and proxy session
+    """
+    lazy = False
+
+    def __init__(self, handler, site_url):
+        self.handler = handler
+        self.site_url = site_url
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+
+        return cls(HTTP11DownloadHandler.from_crawler(crawler), os.environ['LOAD_TEST_SITE_URL'])
+
+    def get_mock_url(self, url):
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        return self.site_url + path
+
+    async def download_request(self, request):
+        mock_request = request.replace(url=self.get_mock_url(request.url))
+        response = await self.handler.download_request(mock_request)
+        # meta of the replaced request is a copy, latency is read by middlewares from the original request
+        if 'download_latency' in mock_request.meta:
+            request.meta['download_latency'] = mock_request.meta['download_latency']
+        return response.replace(url=request.url)
+
+    async def close(self):
+        await self.handler.close()
+
+
+class CallbackTimer:
+    """
+    Spider middleware injected to the actor which measures CPU time of spider callbacks. It is the closest middleware
+    to the spider, so only the callback runs while the next result is pulled from it
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        self.stats.inc_value('load_test/callback_count')
+        iterator = iter(result)
+        while True:
+            start = time.thread_time()
+            try:
+                output = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stats.inc_value('load_test/callback_cpu_time', time.thread_time() - start)
+            yield output
+
+    async def process_spider_output_async(self, response, result, spider):
+        self.stats.inc_value('load_test/callback_count')
+        iterator = result.__aiter__()
+        while True:
+            start = time.thread_time()
+            try:
+                output = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                self.stats.inc_value('load_test/callback_cpu_time', time.thread_time() - start)
+            yield output
+
+
+class StatsDump:
+    """
+    Extension injected to the actor which saves scrapy stats to LOAD_TEST_STATS_FILE when the spider is closed
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy import signals
+
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_closed(self, spider):
+        python = f'{platform.python_implementation()} {platform.python_version()}'
+        self.crawler.stats.set_value('load_test/python', python)
+        with open(os.environ['LOAD_TEST_STATS_FILE'], 'w') as file:
+            json.dump(self.crawler.stats.get_stats(), file, default=str)
+
+
+##########################################
+# Apify Proxy stand-in
+##########################################
+class MockProxy:
+    """
+    Local stand-in of Apify Proxy which forwards requests to the mock website. Each session goes through one exit,
+    requests without a session go through a random exit. A part of exits is banned by the site (403) or slow
+    """
+
+    def __init__(self, bad_exit_ratio, slow_latency=1.0):
+        self.bad_exit_ratio = bad_exit_ratio
+        self.slow_latency = slow_latency
+        self.exits = {}
+        self.requests = 0
+        self.bans = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        # proxy environment variables of the harness are not used for forwarding
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+        self.server = MockServer(('127.0.0.1', 0), self.get_handler())
+        self.port = self.server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_exit(self, session_id):
+        """
+        Returns kind of the exit of a session, 'banned', 'slow' or 'good'
+        """
+        with self.lock:
+            kind = self.exits.get(session_id)
+            if kind is None:
+                draw = random.random()
+                kind = 'good' if draw >= self.bad_exit_ratio else ('banned' if draw < self.bad_exit_ratio / 2
+                                                                   else 'slow')
+                if session_id is not None:
+                    self.exits[session_id] = kind
+            return kind
+
+    def get_stats(self):
+        return {'requests': self.requests, 'connections': self.connections, 'sessions': len(self.exits),
+                'bans': self.bans}
+
+    def get_handler(self):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with proxy.lock:
+                    proxy.connections += 1
+
+            def do_GET(self):
+                with proxy.lock:
+                    proxy.requests += 1
+
+                kind = proxy.get_exit(self.get_session_id())
+                if kind == 'banned':
+                    with proxy.lock:
+                        proxy.bans += 1
+                    self.send_response(403)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if kind == 'slow':
+                    time.sleep(proxy.slow_latency)
+
+                try:
+                    with proxy.opener.open(self.path, timeout=30) as response:
+                        status, headers, body = response.status, response.headers, response.read()
+                except urllib.error.HTTPError as error:
+                    status, headers, body = error.code, error.headers, error.read()
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    if name.lower() not in ('connection', 'keep-alive', 'transfer-encoding', 'content-length',
+                                            'date', 'server'):
+                        self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def get_session_id(self):
+                authorization = self.headers.get('Proxy-Authorization', '')
+                if not authorization.startswith('Basic '):
+                    return None
+                username = base64.b64decode(authorization[6:]).decode('utf-8').split(':')[0]
+                for part in username.split(','):
+                    if part.startswith('session-'):
+                        return part[len('session-'):]
+                return None
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+##########################################
+# Apify API stand-in
+##########################################
+class MockApi:
+    """
+    Local stand-in of Apify API with in-memory key-value stores, datasets and request queues
+    """
+
+    def __init__(self, actor_input):
+        self.records = {('default', 'INPUT'): (json.dumps(actor_input).encode('utf-8'), 'application/json')}
+        self.dataset_items = 0
+        self.queues = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.server = MockServer(('127.0.0.1', 0), self.get_handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, query, body, content_type):
+        """
+        Handles an API call
+        :return: tuple of (status, body, content type)
+        """
+        parts = [unquote(part) for part in path.strip('/').split('/')][1:]
+
+        with self.lock:
+            self.calls += 1
+
+            if parts[:1] == ['key-value-stores']:
+                if len(parts) == 1 and method == 'POST':
+                    return 201, {'data': {'id': query.get('name', ['store'])[0]}}, None
+                if len(parts) == 4 and parts[2] == 'records':
+                    key = (parts[1], parts[3])
+                    if method == 'PUT':
+                        self.records[key] = (body, content_type)
+                        return 201, {}, None
+                    if key not in self.records:
+                        return 404, {'error': {'type': 'record-not-found'}}, None
+                    return 200, self.records[key][0], self.records[key][1]
+
+            if parts[:1] == ['datasets']:
+                if len(parts) == 2:
+                    return 200, {'data': {'id': parts[1]}}, None
+                if len(parts) == 3 and parts[2] == 'items' and method == 'POST':
+                    items = json.loads(body or b'[]')
+                    self.dataset_items += len(items) if isinstance(items, list) else 1
+                    return 201, {}, None
+
+            if parts[:1] == ['request-queues']:
+                if len(parts) == 1 and method == 'POST':
+                    queue_id = query.get('name', ['queue'])[0]
+                    self.queues.setdefault(queue_id, [])
+                    return 201, {'data': {'id': queue_id}}, None
+                queue = self.queues.setdefault(parts[1], [])
+                if len(parts) == 3 and parts[2] == 'requests' and method == 'POST':
+                    request = json.loads(body)
+                    request['id'] = str(len(queue))
+                    queue.append(request)
+                    return 201, {'data': {'requestId': request['id'], 'wasAlreadyPresent': False}}, None
+                if len(parts) == 3 and parts[2] == 'head':
+                    limit = int(query.get('limit', ['100'])[0])
+                    return 200, {'data': {'items': queue[:limit]}}, None
+
+            if parts == ['users', 'me']:
+                return 200, {'data': {'proxy': {'password': 'load-test'}}}, None
+
+        return 404, {'error': {'type': 'not-found'}}, None
+
+    def get_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, method):
+                parsed = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, content, content_type = api.handle(method, parsed.path, parse_qs(parsed.query), body,
+                                                           self.headers.get('Content-Type'))
+                if not isinstance(content, bytes):
+                    content = json.dumps(content).encode('utf-8')
+                    content_type = 'application/json; charset=utf-8'
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type or 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def do_PUT(self):
+                self.respond('PUT')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,273 @@
+import ast
+import configparser
+import fnmatch
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# directories which never contain user's spiders
+VENDORED_DIRS = {'.git', '.hg', '.svn', '.scrapy', '.tox', '.nox', '.venv', 'venv', 'env', '__pycache__',
+                 'node_modules', 'site-packages', 'build', 'dist', 'vendor', 'third_party'}
+
+SCAN_WORKERS = 8
+
+_DONE = object()
+
+
+def find_scrapy_projects(root):
+    """
+    Finds all scrapy projects in a directory tree. Vendored and .gitignored directories are skipped
+    :param root: directory to be scanned
+    :return: sorted list of directories with "scrapy.cfg" file
+    """
+    cfg_files = walk_files([root], lambda name: name == 'scrapy.cfg')
+    return sorted(os.path.dirname(path) for path in cfg_files)
+
+
+def get_spider_module_roots(project_dir):
+    """
+    Finds paths of spider modules of a scrapy project. Reads settings module from "scrapy.cfg" and SPIDER_MODULES from
+    the settings. If they cannot be read, "*/spiders" directories in the project are used
+    :param project_dir: directory with "scrapy.cfg" file
+    :return: list of paths of spider packages (directories) or spider modules (files)
+    """
+    roots = []
+    settings_module = get_settings_module(project_dir)
+
+    if settings_module:
+        spider_modules = get_spider_modules(module_to_path(project_dir, settings_module))
+        if spider_modules is None:
+            # startproject default
+            spider_modules = [settings_module.rsplit('.', 1)[0] + '.spiders']
+
+        for spider_module in spider_modules:
+            path = module_to_path(project_dir, spider_module)
+            if path and path not in roots:
+                roots.append(path)
+
+    if not roots:
+        for entry in os.scandir(project_dir):
+            if entry.is_dir() and os.path.isdir(os.path.join(entry.path, 'spiders')):
+                roots.append(os.path.join(entry.path, 'spiders'))
+
+    return roots
+
+
+def get_settings_module(project_dir):
+    """
+    Reads name of the settings module from "scrapy.cfg"
+    :param project_dir: directory with "scrapy.cfg" file
+    :return: str of the module name or None
+    """
+    cfg = configparser.ConfigParser()
+    try:
+        cfg.read(os.path.join(project_dir, 'scrapy.cfg'))
+    except configparser.Error:
+        return None
+    return cfg.get('settings', 'default', fallback=None)
+
+
+def get_spider_modules(settings_path):
+    """
+    Reads SPIDER_MODULES from settings file without importing it
+    :param settings_path: path to the settings module file or package
+    :return: list of module names or None if SPIDER_MODULES is not set or is not a literal
+    """
+    if settings_path is not None and os.path.isdir(settings_path):
+        # settings package
+        settings_path = os.path.join(settings_path, '__init__.py')
+    if settings_path is None or not os.path.isfile(settings_path):
+        return None
+
+    with open(settings_path, 'r') as settings_file:
+        try:
+            tree = ast.parse(settings_file.read())
+        except SyntaxError:
+            return None
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'SPIDER_MODULES'
+                                                for t in node.targets):
+            try:
+                return list(ast.literal_eval(node.value))
+            except ValueError:
+                return None
+    return None
+
+
+def module_to_path(project_dir, module):
+    """
+    Converts dotted module name to the path of the package directory or the module file
+    :param project_dir: directory from which the module is imported
+    :param module: dotted module name
+    :return: path to the package directory, module file or None if it does not exist
+    """
+    path = os.path.join(project_dir, *module.split('.'))
+    if os.path.isdir(path):
+        return path
+    if os.path.isfile(path + '.py'):
+        return path + '.py'
+    return None
+
+
+def iter_spider_files(project_dir):
+    """
+    Lazily yields python files from spider modules of a scrapy project, including nested packages
+    :param project_dir: directory with "scrapy.cfg" file
+    :return: generator of paths to python files
+    """
+    roots = get_spider_module_roots(project_dir)
+    dirs = []
+
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+        else:
+            dirs.append(root)
+
+    yield from walk_files(dirs, lambda name: name.endswith('.py'), project_dir)
+
+
+def scan_spider_files(root):
+    """
+    Lazily yields spider files of every scrapy project in a directory tree
+    :param root: directory to be scanned
+    :return: generator of tuples of (project_dir, path to python file)
+    """
+    for project_dir in find_scrapy_projects(root):
+        for path in iter_spider_files(project_dir):
+            yield project_dir, path
+
+
+def walk_files(roots, match, ignore_root=None):
+    """
+    Walks directories with os.scandir in parallel threads and lazily yields matching files.
+    Vendored directories and paths ignored by .gitignore files are pruned
+    :param roots: directories to be walked
+    :param match: function which gets a file name and returns True if the file should be yielded
+    :param ignore_root: directory from which .gitignore files are read down to the roots. Defaults to each root
+    :return: generator of paths to files
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    stopped = threading.Event()
+    pending = 0
+
+    def scan(path, rules):
+        try:
+            if stopped.is_set():
+                return
+            rules = rules + read_gitignore(path)
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if (is_dir and entry.name in VENDORED_DIRS) or is_ignored(entry.path, is_dir, rules):
+                        continue
+                    if is_dir:
+                        submit(entry.path, rules)
+                    elif match(entry.name):
+                        results.put(entry.path)
+        except OSError:
+            pass
+        finally:
+            results.put(_DONE)
+
+    def submit(path, rules):
+        nonlocal pending
+        with lock:
+            pending += 1
+        pool.submit(scan, path, rules)
+
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        try:
+            for root in roots:
+                submit(root, get_parent_gitignore_rules(ignore_root or root, root))
+
+            while True:
+                with lock:
+                    if pending == 0:
+                        break
+                item = results.get()
+                if item is _DONE:
+                    with lock:
+                        pending -= 1
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+
+def get_parent_gitignore_rules(ignore_root, path):
+    """
+    Reads .gitignore files from ignore_root down to the parent of path
+    :param ignore_root: the topmost directory
+    :param path: directory which is walked
+    :return: tuple of rules
+    """
+    rel = os.path.relpath(path, ignore_root)
+    if rel.startswith('..') or rel == '.':
+        return ()
+
+    current = ignore_root
+    rules = read_gitignore(current)
+    for part in rel.split(os.sep)[:-1]:
+        current = os.path.join(current, part)
+        rules = rules + read_gitignore(current)
+    return rules
+
+
+def read_gitignore(directory):
+    """
+    Reads .gitignore file of a directory
+    :param directory: directory with .gitignore file
+    :return: tuple of rules (base directory, pattern, negated, directories only, anchored)
+    """
+    try:
+        with open(os.path.join(directory, '.gitignore'), 'r') as gitignore:
+            lines = gitignore.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return ()
+
+    rules = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line.startswith('**/'):
+            line = line[3:]
+        anchored = '/' in line
+        rules.append((directory, line.lstrip('/'), negated, dir_only, anchored))
+
+    return tuple(rules)
+
+
+def is_ignored(path, is_dir, rules):
+    """
+    Checks if path is ignored by .gitignore rules. The last matching rule wins
+    :param path: path of a file or a directory
+    :param is_dir: True if path is a directory
+    :param rules: rules from read_gitignore
+    :return: boolean
+    """
+    ignored = False
+    name = os.path.basename(path)
+
+    for base, pattern, negated, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        if anchored:
+            rel = os.path.relpath(path, base).replace(os.sep, '/')
+            matched = fnmatch.fnmatchcase(rel, pattern)
+        else:
+            matched = fnmatch.fnmatchcase(name, pattern)
+        if matched:
+            ignored = not negated
+
+    return ignored